@@ -0,0 +1,34 @@
+from environments.minigrids import Minigrid_MDP, Minigrid_LMDP, Minigrid_LMDP_transition
+from tuning_test import hill13_map
+from test import maze18_map
+import numpy as np
+import time
+
+
+def timed(solver):
+    start_time = time.time()
+    result = solver()
+    return result, time.time() - start_time
+
+
+if __name__ == "__main__":
+
+    epsilon = 1e-10
+    domains = {"hill13": hill13_map, "maze18": maze18_map}
+
+    for name, grid_map in domains.items():
+        grid_size = len(grid_map) - 2
+        print(f"{name}:")
+
+        for gamma in [0.95, 0.999]:
+            minigrid_mdp = Minigrid_MDP(grid_size, map=grid_map, gamma=gamma)
+            (Q, _, n_steps), plain_time = timed(lambda: minigrid_mdp.value_iteration(epsilon))
+            (Q_acc, _, n_steps_acc), acc_time = timed(lambda: minigrid_mdp.value_iteration(epsilon, accelerate=True))
+            print(f"  Value iteration (gamma={gamma}): {n_steps} iterations in {plain_time:.3f}s, Anderson: {n_steps_acc} iterations in {acc_time:.3f}s, Max |Q difference|: {np.abs(Q - Q_acc).max():.2e}")
+
+        for lmbda in [1, 5, 10]:
+            for lmdp_class in [Minigrid_LMDP, Minigrid_LMDP_transition]:
+                minigrid_lmdp = lmdp_class(grid_size, map=grid_map, lmbda=lmbda)
+                (Z, n_steps), plain_time = timed(lambda: minigrid_lmdp.power_iteration(lmbda, epsilon))
+                (Z_acc, n_steps_acc), acc_time = timed(lambda: minigrid_lmdp.power_iteration(lmbda, epsilon, accelerate=True))
+                print(f"  Power iteration ({lmdp_class.__name__}, lambda={lmbda}): {n_steps} iterations in {plain_time:.3f}s, Anderson: {n_steps_acc} iterations in {acc_time:.3f}s, Max |V difference|: {np.max(np.abs(minigrid_lmdp.Z_to_V(Z, lmbda) - minigrid_lmdp.Z_to_V(Z_acc, lmbda))):.2e}")
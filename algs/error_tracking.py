@@ -0,0 +1,32 @@
+import numpy as np
+
+
+class SquaredErrorTracker:
+    """
+    Keeps the mean squared error between an estimated and a reference value function when the estimate changes
+    one state at a time, at O(1) cost per update.
+
+    The running sum is recomputed from the per-state errors every n_states updates (O(1) amortized) to avoid the
+    accumulation of floating point drift, and whenever a non-finite error is involved.
+    """
+    def __init__(self, V_est, V):
+        self.V = V
+        self.errors = np.square(V_est - V)
+        self.sse = self.errors.sum()
+        self.n_updates = 0
+
+    def update(self, s, value):
+        """Set the estimated value of state s."""
+
+        error = (value - self.V[s])**2
+        previous_error = self.errors[s]
+        self.errors[s] = error
+        self.n_updates += 1
+
+        if self.n_updates % len(self.errors) == 0 or not (np.isfinite(error) and np.isfinite(previous_error)):
+            self.sse = self.errors.sum()
+        else:
+            self.sse += error - previous_error
+
+    def mse(self):
+        return max(self.sse, 0) / len(self.errors)
@@ -1,5 +1,6 @@
 import numpy as np
 import time
+from algs.error_tracking import SquaredErrorTracker
 
 class QLearning:
     """
@@ -72,7 +73,73 @@ class QLearning:
             self.state = np.random.choice(self.mdp.n_nonterminal_states) if np.random.rand() < self.reset_randomness else self.mdp.s0
 
 
-def Qlearning_training(qlearning, n_steps=int(5e5), V=None):
+class BatchQLearning(QLearning):
+    """
+    Implements Q-learning with epsilon-greedy exploration for n_walkers agents that advance in lockstep and share Q
+
+    When several walkers update the same state-action pair in a step, the pair receives the mean of their deltas.
+    Each walker resets on its own when reaching a terminal state.
+    """
+    def __init__(self, mdp, n_walkers=64, gamma=1, epsilon=1, epsilon_decay=0.999,
+                 epsilon_min=0, c = 1000000, reset_randomness = 0.0, seed=42):
+        super().__init__(mdp, gamma=gamma, epsilon=epsilon, epsilon_decay=epsilon_decay, epsilon_min=epsilon_min,
+                         c=c, reset_randomness=reset_randomness, seed=seed)
+        self.n_walkers = n_walkers
+        self.rng = np.random.default_rng(seed)
+        self.states = np.full(n_walkers, self.mdp.s0)
+        self.r = np.zeros(n_walkers)
+        self.episode_end = np.zeros(n_walkers, dtype=bool)
+
+    def get_delta(self, r, x, a, y):
+        """
+        :param r: rewards
+        :param x: current states
+        :param a: current actions
+        :param y: next states
+        :return:
+        """
+        max_q_y_a = self.Q[y, :].max(axis=1)
+        q_x_a = self.Q[x, a]
+
+        return r + self.gamma * max_q_y_a - q_x_a
+
+    def get_action(self, states):
+        explore = self.rng.random(len(states)) < self.epsilon
+        return np.where(explore, self.rng.integers(self.mdp.n_actions, size=len(states)), self.Q[states, :].argmax(axis=1))
+
+    def step(self):
+
+        # Take mdp actions
+        a = self.get_action(self.states)
+        next_states, self.r, self.episode_end = self.mdp.act_batch(self.states, a)
+
+        # Get Delta Updates
+        delta = self.get_delta(self.r, self.states, a, next_states)
+
+        # Update Q with the mean delta of the walkers at each state-action pair
+        pairs, walker_to_pair = np.unique(self.states * self.mdp.n_actions + a, return_inverse=True)
+        delta_sum = np.zeros(len(pairs))
+        np.add.at(delta_sum, walker_to_pair, delta)
+        np.add.at(self.Q.reshape(-1), pairs, self.learning_rate * delta_sum / np.bincount(walker_to_pair))
+
+        # Keep track of state-action visits
+        np.add.at(self.Nsa, (self.states, a), 1)
+
+        self.states = next_states
+
+        if self.episode_end.any():
+            n_ends = self.episode_end.sum()
+            self.r[self.episode_end] += np.min(self.mdp.R[self.states[self.episode_end]], axis=1)
+            self.n_episodes += n_ends
+            self.epsilon = max(self.epsilon * self.epsilon_decay**n_ends, self.epsilon_min)
+            self.learning_rate = self.c / (self.c + self.n_episodes)
+            random_reset = self.rng.random(n_ends) < self.reset_randomness
+            self.states[self.episode_end] = np.where(random_reset, self.rng.integers(self.mdp.n_nonterminal_states, size=n_ends), self.mdp.s0)
+
+
+def Qlearning_training(qlearning, n_steps=int(5e5), V=None, error_every=1):
+    """Train Q-learning for n_steps steps. The value error is tracked incrementally and recorded every error_every steps."""
+
     tt = 0
     l0 = 0
     lengths = []
@@ -80,14 +147,17 @@ def Qlearning_training(qlearning, n_steps=int(5e5), V=None):
     rewards = np.zeros(n_steps)
     throughputs = np.zeros(n_steps)
 
-    V_error = np.zeros((n_steps))
+    V_error = np.zeros(-(-n_steps // error_every))
+    error_tracker = SquaredErrorTracker(qlearning.Q.max(axis=1), V) if V is not None else None
     start_time = time.time()
     while tt < n_steps:
+        state = qlearning.state
         qlearning.step()
-        # Store estimate of Q*
-        if tt < len(V_error): 
-            V_est = qlearning.Q.max(axis=1)
-            V_error[tt] = np.mean(np.square(V_est - V))
+        # Store estimate of Q* (only the row of the updated state changes)
+        if error_tracker is not None:
+            error_tracker.update(state, qlearning.Q[state].max())
+            if tt % error_every == 0:
+                V_error[tt // error_every] = error_tracker.mse()
         cumulative_reward += qlearning.r
         tt +=1
 
@@ -117,6 +187,49 @@ def Qlearning_training(qlearning, n_steps=int(5e5), V=None):
 
     return Q_est, V_error, greedy_policy, throughputs, rewards
 
+def BatchQlearning_training(qlearning: BatchQLearning, n_steps=int(1e4), V=None):
+    """Train a batch of Q-learning walkers for n_steps lockstep steps (n_steps * n_walkers transitions).
+    Rewards and throughputs at each step average the last completed episode of every walker."""
+
+    tt = 0
+    cumulative_rewards = np.zeros(qlearning.n_walkers)
+    last_rewards = np.full(qlearning.n_walkers, np.nan)
+    rewards = np.full(n_steps, np.nan)
+    throughputs = np.full(n_steps, np.nan)
+
+    V_error = np.zeros((n_steps))
+    start_time = time.time()
+    while tt < n_steps:
+        qlearning.step()
+        if V is not None:
+            V_est = qlearning.Q.max(axis=1)
+            V_error[tt] = np.mean(np.square(V_est - V))
+        cumulative_rewards += qlearning.r
+
+        # Per-walker episode accounting
+        if qlearning.episode_end.any():
+            last_rewards[qlearning.episode_end] = cumulative_rewards[qlearning.episode_end]
+            cumulative_rewards[qlearning.episode_end] = 0
+        if not np.isnan(last_rewards).all():
+            rewards[tt] = np.nanmean(last_rewards)
+            throughputs[tt] = np.nanmean(-1/last_rewards)
+        tt += 1
+
+        if tt % 10000 == 0:
+
+            elapsed_time = time.time() - start_time
+            estimated_total_time = (elapsed_time / tt) * n_steps
+            estimated_remaining_time = estimated_total_time - elapsed_time
+
+            print(f"Step: {tt}/{n_steps}, Transitions: {tt * qlearning.n_walkers}, Time: {elapsed_time/60:.2f}m, ETA: {estimated_remaining_time/60:.2f}m")
+
+    Q_est = qlearning.Q
+
+    # Compute greedy policy (with estimated Q)
+    greedy_policy = np.argmax(qlearning.Q, axis=1)
+
+    return Q_est, V_error, greedy_policy, throughputs, rewards
+
 def print_Qlearning(Q_opt, Q_est, mdp):
 
     for state in range(mdp.n_states):
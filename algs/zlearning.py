@@ -1,5 +1,7 @@
 import numpy as np
 from scipy.sparse import csr_matrix, isspmatrix_csr
+from frameworks.sampling import row_positions
+from algs.error_tracking import SquaredErrorTracker
 import time
 
 #-------------------------------
@@ -16,16 +18,45 @@ class ZLearning:
         self.learning_rate = 1
         self.c = c
         self.n_episodes = 0
-        self.Z = np.ones(lmdp.n_states)
-        self.Z[self.lmdp.n_nonterminal_states:] = np.exp(self.lmdp.R[self.lmdp.n_nonterminal_states:] / lmbda)
-        self.P0 = self.lmdp.P0
-        self.Pu = self.lmdp.P0
+        self._initialize_Z()
+        self.P0 = csr_matrix(self.lmdp.P0)
+        self.Pu = self.P0
         self.reset_randomness = reset_randomness
         self.state = self.lmdp.s0
         self.r = 0
         self.episode_end = False
         self.naive = naive
 
+        if not self.naive:
+            # Pu shares the sparsity structure of P0, and the reverse adjacency (CSC) of P0 gives the rows whose successor set contains each state
+            self.Pu = self.P0.copy()
+            self.predecessors = self.P0.tocsc()
+            self._update_Pu(np.arange(self.lmdp.n_nonterminal_states))
+
+    def _initialize_Z(self):
+        """Start from Z = 1 on the nonterminal states and the exact Z values of the terminal states."""
+
+        self.Z = np.ones(self.lmdp.n_states)
+        self.Z[self.lmdp.n_nonterminal_states:] = np.exp(self.lmdp.R[self.lmdp.n_nonterminal_states:] / self.lmbda)
+
+    def value(self, states = slice(None)):
+        """Return the value estimate of the given states (all by default)."""
+
+        return self.lmdp.Z_to_V(self.Z[states])
+
+    def _update_Pu(self, rows):
+        """Recompute the controlled transition probabilities of the given rows from the current Z."""
+
+        if len(rows) == 0:
+            return
+
+        positions, lengths, offsets = row_positions(self.Pu.indptr, rows)
+        weights = self.P0.data[positions] * self.Z[self.Pu.indices[positions]]
+        row_sums = np.add.reduceat(weights, offsets)
+        self.Pu.data[positions] = weights / np.repeat(row_sums, lengths)
+
+        # Keep the next state sampler of Pu in sync with the modified rows
+        self.lmdp.sampler(self.Pu).update_rows(rows)
 
     def get_Z(self, r, x, y):
         """
@@ -35,27 +66,34 @@ class ZLearning:
         :return: Delta update
         """
 
-        Gz = self.Z[y] if self.naive else self.lmdp.P0[x].dot(self.Z)
+        if self.naive:
+            Gz = self.Z[y]
+        else:
+            start, end = self.P0.indptr[x], self.P0.indptr[x + 1]
+            Gz = self.P0.data[start:end].dot(self.Z[self.P0.indices[start:end]])
 
         zjk = np.exp(r / self.lmbda) * Gz
 
         return zjk - self.Z[x]
 
+    def _update_Z(self, r, x, y):
+        """Move Z of the current state x towards its sampled target."""
+
+        delta = self.get_Z(r, x, y)
+        self.Z[x] += self.learning_rate * delta
+
     def step(self):
 
         # Sample next state
         next_state, _ , self.episode_end = self.lmdp.act(self.state, self.Pu) if not self.naive else self.lmdp.act(self.state, self.P0)
 
-        # Get Delta
-        self.r = self.lmdp.R[self.state]
-        delta = self.get_Z(self.r, self.state, next_state)
-
         # Update Z
-        self.Z[self.state] += self.learning_rate * delta
+        self.r = self.lmdp.R[self.state]
+        self._update_Z(self.r, self.state, next_state)
 
-        # Compute Pu
+        # Refresh the rows of Pu that lead to the updated state
         if not self.naive:
-            self.Pu = self.lmdp.compute_Pu(self.Z)
+            self._update_Pu(self.predecessors.indices[self.predecessors.indptr[self.state]:self.predecessors.indptr[self.state + 1]])
 
         # Update state
         self.state = next_state
@@ -66,7 +104,138 @@ class ZLearning:
             self.learning_rate = self.c / (self.c + self.n_episodes)
             self.state = np.random.choice(self.lmdp.n_nonterminal_states) if np.random.rand() < self.reset_randomness else self.lmdp.s0
 
-def Zlearning_training(zlearning: ZLearning, n_steps = int(5e5), V=None):
+class LogZLearning(ZLearning):
+    """
+    Implements Z-learning on log Z
+
+    The update Z(x) <- (1 - a) Z(x) + a exp(r / lmbda) G(x)z is applied as a log-sum-exp of log desirabilities, and each
+    row of Pu is a softmax of log P0 + log Z, so the Z values that underflow to 0 in the plain updates (large negative
+    rewards, small lambdas, long paths) stay representable, and log Z can be stored in float32.
+    """
+    def __init__(self, lmdp, lmbda=1, c = 10000, reset_randomness = 0.0, naive = False, dtype = np.float64):
+        self.dtype = dtype
+        super().__init__(lmdp, lmbda=lmbda, c=c, reset_randomness=reset_randomness, naive=naive)
+
+    def _initialize_Z(self):
+        self.log_Z = np.zeros(self.lmdp.n_states, dtype=self.dtype)
+        self.log_Z[self.lmdp.n_nonterminal_states:] = self.lmdp.R[self.lmdp.n_nonterminal_states:] / self.lmbda
+
+    @property
+    def Z(self):
+        return np.exp(self.log_Z)
+
+    def value(self, states = slice(None)):
+        """Return the value estimate of the given states (all by default)."""
+
+        return self.lmdp.lmbda * self.log_Z[states]
+
+    def _update_Pu(self, rows):
+        """Recompute the controlled transition probabilities of the given rows from the current log Z."""
+
+        if len(rows) == 0:
+            return
+
+        positions, lengths, offsets = row_positions(self.Pu.indptr, rows)
+        with np.errstate(divide='ignore'):
+            x = np.log(self.P0.data[positions]) + self.log_Z[self.Pu.indices[positions]]
+        weights = np.exp(x - np.repeat(np.maximum.reduceat(x, offsets), lengths))
+        self.Pu.data[positions] = weights / np.repeat(np.add.reduceat(weights, offsets), lengths)
+
+        # Keep the next state sampler of Pu in sync with the modified rows
+        self.lmdp.sampler(self.Pu).update_rows(rows)
+
+    def get_log_Z(self, r, x, y):
+        """
+        :param r: reward of current state
+        :param x: current state (in index format)
+        :param y: next state (in index format)
+        :return: log of the target exp(r / lmbda) G(x)z of the update
+        """
+
+        if self.naive:
+            log_Gz = self.log_Z[y]
+        else:
+            start, end = self.P0.indptr[x], self.P0.indptr[x + 1]
+            with np.errstate(divide='ignore'):
+                log_weights = np.log(self.P0.data[start:end]) + self.log_Z[self.P0.indices[start:end]]
+            log_max = log_weights.max()
+            log_Gz = log_max + np.log(np.exp(log_weights - log_max).sum()) if log_max > -np.inf else log_max
+
+        return r / self.lmbda + log_Gz
+
+    def _update_Z(self, r, x, y):
+        """Move log Z of the current state x towards its sampled target, log((1 - a) Z(x) + a target)."""
+
+        with np.errstate(divide='ignore'):
+            self.log_Z[x] = np.logaddexp(np.log1p(-self.learning_rate) + self.log_Z[x], np.log(self.learning_rate) + self.get_log_Z(r, x, y))
+
+class BatchZLearning(ZLearning):
+    """
+    Implements Z-learning with n_walkers agents that advance in lockstep over the same LMDP and share Z
+
+    All walkers sample their next states in one vectorized draw. When several walkers update the same state in a step,
+    the state receives the mean of their deltas. Each walker resets on its own when reaching a terminal state.
+    """
+    def __init__(self, lmdp, n_walkers=64, lmbda=1, c = 10000, reset_randomness = 0.0, naive = False, seed = None):
+        super().__init__(lmdp, lmbda=lmbda, c=c, reset_randomness=reset_randomness, naive=naive)
+        self.n_walkers = n_walkers
+        self.rng = np.random.default_rng(seed)
+        self.states = np.full(n_walkers, self.lmdp.s0)
+        self.r = np.zeros(n_walkers)
+        self.episode_end = np.zeros(n_walkers, dtype=bool)
+
+    def get_Z(self, r, x, y):
+        """
+        :param r: rewards of the current states
+        :param x: current states (in index format)
+        :param y: next states (in index format)
+        :return: Delta updates
+        """
+
+        if self.naive:
+            Gz = self.Z[y]
+        else:
+            positions, _, offsets = row_positions(self.P0.indptr, x)
+            Gz = np.add.reduceat(self.P0.data[positions] * self.Z[self.P0.indices[positions]], offsets)
+
+        zjk = np.exp(r / self.lmbda) * Gz
+
+        return zjk - self.Z[x]
+
+    def step(self):
+
+        # Sample next states of all walkers
+        next_states = self.lmdp.sampler(self.P0 if self.naive else self.Pu).sample_batch(self.states)
+        self.episode_end = next_states >= self.lmdp.n_nonterminal_states
+
+        # Get Deltas
+        self.r = self.lmdp.R[self.states]
+        delta = self.get_Z(self.r, self.states, next_states)
+
+        # Update Z with the mean delta of the walkers at each state
+        updated_states, walker_to_state = np.unique(self.states, return_inverse=True)
+        mean_delta = np.bincount(walker_to_state, weights=delta) / np.bincount(walker_to_state)
+        self.Z[updated_states] += self.learning_rate * mean_delta
+
+        # Refresh the rows of Pu that lead to the updated states
+        if not self.naive:
+            positions, _, _ = row_positions(self.predecessors.indptr, updated_states)
+            self._update_Pu(np.unique(self.predecessors.indices[positions]))
+
+        # Update states
+        self.states = next_states
+
+        if self.episode_end.any():
+            self.r[self.episode_end] += self.lmdp.R[self.states[self.episode_end]]
+            self.n_episodes += self.episode_end.sum()
+            self.learning_rate = self.c / (self.c + self.n_episodes)
+            n_resets = self.episode_end.sum()
+            random_reset = self.rng.random(n_resets) < self.reset_randomness
+            self.states[self.episode_end] = np.where(random_reset, self.rng.integers(self.lmdp.n_nonterminal_states, size=n_resets), self.lmdp.s0)
+
+def Zlearning_training(zlearning: ZLearning, n_steps = int(5e5), V=None, error_every=1):
+    """Train Z-learning for n_steps steps. The value error is tracked incrementally and recorded every error_every steps."""
+
     tt = 0
     l0 = 0
     z_lengths = []
@@ -74,13 +243,17 @@ def Zlearning_training(zlearning: ZLearning, n_steps = int(5e5), V=None):
     z_rewards = np.zeros(n_steps)
     z_throughputs = np.zeros(n_steps)
 
-    V_error = np.zeros((n_steps))
+    V_error = np.zeros(-(-n_steps // error_every))
+    error_tracker = SquaredErrorTracker(zlearning.value(), V) if V is not None else None
     start_time = time.time()
     while tt < n_steps:
+        state = zlearning.state
         zlearning.step()
-        if tt < len(V_error) and V is not None:
-            V_est = zlearning.lmdp.Z_to_V(zlearning.Z)
-            V_error[tt] = np.mean(np.square(V_est - V))
+        # Only Z of the updated state changes
+        if error_tracker is not None:
+            error_tracker.update(state, zlearning.value(state))
+            if tt % error_every == 0:
+                V_error[tt // error_every] = error_tracker.mse()
         cumulative_reward += zlearning.r
         tt += 1
 
@@ -104,6 +277,49 @@ def Zlearning_training(zlearning: ZLearning, n_steps = int(5e5), V=None):
         z_throughputs[l0:tt] = -1/(z_rewards[l0-1])
         z_rewards[l0:tt] = z_rewards[l0-1]
 
-    zlearning.Pu = zlearning.lmdp.compute_Pu(zlearning.Z)
+    # Pu is already kept up to date unless learning naively
+    if zlearning.naive:
+        zlearning.Pu = zlearning.lmdp.compute_Pu(zlearning.Z)
+
+    return zlearning.Z, V_error, z_throughputs, z_rewards
+
+def BatchZlearning_training(zlearning: BatchZLearning, n_steps = int(1e4), V=None):
+    """Train a batch of Z-learning walkers for n_steps lockstep steps (n_steps * n_walkers transitions).
+    Rewards and throughputs at each step average the last completed episode of every walker."""
+
+    tt = 0
+    cumulative_rewards = np.zeros(zlearning.n_walkers)
+    last_rewards = np.full(zlearning.n_walkers, np.nan)
+    z_rewards = np.full(n_steps, np.nan)
+    z_throughputs = np.full(n_steps, np.nan)
+
+    V_error = np.zeros((n_steps))
+    start_time = time.time()
+    while tt < n_steps:
+        zlearning.step()
+        if V is not None:
+            V_est = zlearning.lmdp.Z_to_V(zlearning.Z)
+            V_error[tt] = np.mean(np.square(V_est - V))
+        cumulative_rewards += zlearning.r
+
+        # Per-walker episode accounting
+        if zlearning.episode_end.any():
+            last_rewards[zlearning.episode_end] = cumulative_rewards[zlearning.episode_end]
+            cumulative_rewards[zlearning.episode_end] = 0
+        if not np.isnan(last_rewards).all():
+            z_rewards[tt] = np.nanmean(last_rewards)
+            z_throughputs[tt] = np.nanmean(-1/last_rewards)
+        tt += 1
+
+        if tt % 10000 == 0:
+
+            elapsed_time = time.time() - start_time
+            estimated_total_time = (elapsed_time / tt) * n_steps
+            estimated_remaining_time = estimated_total_time - elapsed_time
+
+            print(f"Step: {tt}/{n_steps}, Transitions: {tt * zlearning.n_walkers}, Time: {elapsed_time/60:.2f}m, ETA: {estimated_remaining_time/60:.2f}m")
+
+    if zlearning.naive:
+        zlearning.Pu = zlearning.lmdp.compute_Pu(zlearning.Z)
 
     return zlearning.Z, V_error, z_throughputs, z_rewards
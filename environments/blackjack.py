@@ -2,6 +2,7 @@ import numpy as np
 from frameworks.mdp import MDP
 import matplotlib.pyplot as plt
 from gym.envs.toy_text import BlackjackEnv
+from scipy.sparse import csr_matrix
 
 
 class Black_Jack_MDP(MDP):
@@ -62,6 +63,13 @@ class Black_Jack_MDP(MDP):
     def _create_P(self):
         """Create the transition matrix for a deterministic MDP."""
 
+        rows, cols, data = [], [], []
+
+        def add_transition(index, action, next_index, p):
+            rows.append(index * self.n_actions + action)
+            cols.append(next_index)
+            data.append(p)
+
         for sum in range(4, 22):
             for dealer in range(1, 11):
                 for ace in range(2):
@@ -69,12 +77,12 @@ class Black_Jack_MDP(MDP):
                     state = (sum, dealer, ace, 1, dealer_ace)
                     index = self.state_to_index[state]
                     terminal_index = self.state_to_index[(sum, dealer, ace, 0, dealer_ace)]
-                    self.P[index, 0, terminal_index] = 1
+                    add_transition(index, 0, terminal_index, 1)
                     for card in self.deck:
                         ac = 1 if card == 1 else ace
                         next_state = (sum + card, dealer, ac, int(sum + card <= 21), dealer_ace if sum + card <= 21 else 0)
                         next_index = self.state_to_index[next_state]
-                        self.P[index, 1, next_index] += self.deck[card] / 13
+                        add_transition(index, 1, next_index, self.deck[card] / 13)
 
             for dealer in range(1, 17):
                 for ace in range(2):
@@ -84,15 +92,18 @@ class Black_Jack_MDP(MDP):
                         if dealer >= 7 and dealer <= 11 and dealer_ace == 1:
                             dealer_next_state = (sum, dealer+10, ace, 0, dealer_ace)
                             dealer_next_index = self.state_to_index[dealer_next_state]
-                            self.P[dealer_index, 1, dealer_next_index] = 1
-                            self.P[dealer_index, 0, dealer_next_index] = 1
+                            add_transition(dealer_index, 1, dealer_next_index, 1)
+                            add_transition(dealer_index, 0, dealer_next_index, 1)
                         else:
                             for card in self.deck:
                                 d_ace = 1 if card == 1 else dealer_ace
                                 next_dealer_state = (sum, min(dealer + card,22), ace, 0, d_ace)
                                 next_dealer_index = self.state_to_index[next_dealer_state]
-                                self.P[dealer_index, 1, next_dealer_index] += self.deck[card] / 13
-                                self.P[dealer_index, 0, next_dealer_index] += self.deck[card] / 13
+                                add_transition(dealer_index, 1, next_dealer_index, self.deck[card] / 13)
+                                add_transition(dealer_index, 0, next_dealer_index, self.deck[card] / 13)
+
+        # Duplicated entries are summed up when building the sparse matrix
+        self.P = csr_matrix((data, (rows, cols)), shape=self.P.shape)
                     
 
 
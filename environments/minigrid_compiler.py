@@ -0,0 +1,156 @@
+import numpy as np
+
+# Cell codes of the occupancy grid
+EMPTY, WALL, LAVA, GOAL = 0, 1, 2, 3
+CELL_TYPES = {WALL: "wall", LAVA: "lava", GOAL: "goal"}
+
+# Minigrid actions
+LEFT, RIGHT, FORWARD = 0, 1, 2
+
+DIR_TO_VEC = np.array([
+    # Pointing right (positive X)
+    (1, 0),
+    # Down (positive Y)
+    (0, 1),
+    # Pointing left (negative X)
+    (-1, 0),
+    # Up (negative Y)
+    (0, -1),
+])
+
+
+def occupancy_grid(grid_size, objects = {}, map = None):
+    """Build the occupancy grid of a minigrid layout, following the same placement rules as CustomEnv.
+
+    :return: The (width, height) array of cell codes indexed as [x, y], the lists of walls and lavas, and the agent start position."""
+
+    size = grid_size + 2
+    grid = np.full((size, size), EMPTY, dtype=np.int8)
+
+    # Surrounding walls
+    grid[0, :] = grid[-1, :] = grid[:, 0] = grid[:, -1] = WALL
+    agent_start_pos = (1, 1)
+
+    if map is not None:
+
+        assert len(map) == size, f"Map height {len(map)} != grid height {size}"
+        assert len(map[0]) == size, f"Map width {len(map[0])} != grid width {size}"
+
+        # Rows may be ragged (e.g. an extra border character), cells outside the grid are ignored as in CustomEnv
+        chars = np.array([list(row[:size].ljust(size)) for row in map])
+        interior = (grid == EMPTY).T # Indexed as [y, x] like the map
+        for char, code in (("W", WALL), ("L", LAVA), ("G", GOAL)):
+            grid.T[interior & (chars == char)] = code
+
+        walls = [(x, y) for y, x in np.argwhere(interior & (chars == "W")).tolist()]
+        lavas = [(x, y) for y, x in np.argwhere(interior & (chars == "L")).tolist()]
+        agents = np.argwhere(interior & (chars == "A"))
+        if len(agents):
+            agent_start_pos = (int(agents[-1][1]), int(agents[-1][0]))
+
+    else:
+
+        walls = objects.get("walls", [])
+        lavas = objects.get("lavas", [])
+
+        for positions, code in ((walls, WALL), (lavas, LAVA)):
+            for x, y in positions:
+                # Check if x,y is within the grid and is empty
+                if x < size and y < size and grid[x, y] == EMPTY:
+                    grid[x, y] = code
+                else:
+                    print("Wall position is out of bounds or is not empty")
+
+        # Place a goal square in the bottom-right corner
+        grid[size - 2, size - 2] = GOAL
+
+    return grid, walls, lavas, agent_start_pos
+
+
+class CompiledMinigrid:
+    """
+    Array representation of a minigrid layout: state enumeration, state lookup and successor table.
+
+    States are (x, y, orientation) triplets over the non-wall cells, ordered by x, y and orientation,
+    with the nonterminal states first. Actions are left (0), right (1) and forward (2).
+    """
+    def __init__(self, grid_size, objects = {}, map = None, terminal_types = ("goal", "lava"), agent_start_dir = 0):
+        self.grid_size = grid_size
+        self.grid, self.walls, self.lavas, self.agent_start_pos = occupancy_grid(grid_size, objects, map)
+        self.agent_start_dir = agent_start_dir
+
+        terminal_codes = [code for code, name in CELL_TYPES.items() if name in terminal_types]
+        valid = self.grid != WALL
+
+        # Enumerate the states of every valid cell, moving terminal states to the end
+        cells = np.argwhere(valid)
+        states = np.column_stack((np.repeat(cells, 4, axis=0), np.tile(np.arange(4), len(cells))))
+        is_terminal = np.isin(self.grid[states[:, 0], states[:, 1]], terminal_codes)
+        self.states = states[np.argsort(is_terminal, kind='stable')]
+        self.n_states = len(self.states)
+        self.n_nonterminal_states = self.n_states - int(is_terminal.sum())
+
+        self.state_index = np.full(self.grid.shape + (4,), -1)
+        self.state_index[self.states[:, 0], self.states[:, 1], self.states[:, 2]] = np.arange(self.n_states)
+        self.s0 = self.state_index[self.agent_start_pos[0], self.agent_start_pos[1], self.agent_start_dir]
+
+        # Successor table of the nonterminal states
+        x, y, o = self.states[:self.n_nonterminal_states].T
+        fwd_x, fwd_y = x + DIR_TO_VEC[o, 0], y + DIR_TO_VEC[o, 1]
+        moved = valid[fwd_x, fwd_y]
+        self.next_states = np.column_stack((
+            self.state_index[x, y, (o - 1) % 4],
+            self.state_index[x, y, (o + 1) % 4],
+            self.state_index[np.where(moved, fwd_x, x), np.where(moved, fwd_y, y), o],
+        ))
+
+    # Fields of a compiled layout, stored and restored as arrays
+    FIELDS = ("grid", "walls", "lavas", "agent_start_pos", "agent_start_dir", "states", "n_nonterminal_states", "state_index", "next_states")
+
+    def to_arrays(self):
+        """Return the fields of the compiled layout as a dictionary of arrays."""
+
+        return {name: np.asarray(getattr(self, name)) for name in self.FIELDS}
+
+    @classmethod
+    def from_arrays(cls, grid_size, arrays):
+        """Restore a compiled layout from the arrays returned by to_arrays, without compiling it again."""
+
+        model = cls.__new__(cls)
+        model.grid_size = grid_size
+        model.grid = arrays["grid"]
+        model.walls = [tuple(position) for position in np.reshape(arrays["walls"], (-1, 2)).astype(int).tolist()]
+        model.lavas = [tuple(position) for position in np.reshape(arrays["lavas"], (-1, 2)).astype(int).tolist()]
+        model.agent_start_pos = tuple(np.asarray(arrays["agent_start_pos"]).tolist())
+        model.agent_start_dir = int(arrays["agent_start_dir"])
+        model.states = arrays["states"]
+        model.n_states = len(model.states)
+        model.n_nonterminal_states = int(arrays["n_nonterminal_states"])
+        model.state_index = arrays["state_index"]
+        model.s0 = model.state_index[model.agent_start_pos[0], model.agent_start_pos[1], model.agent_start_dir]
+        model.next_states = arrays["next_states"]
+        return model
+
+    def is_valid_position(self, x, y):
+        """Testing whether a coordinate is a valid location."""
+
+        size = self.grid_size + 2
+        return 0 < x < size and 0 < y < size and self.grid[x, y] != WALL
+
+    def cell_type(self, x, y):
+        """Return the type of the object at a cell, None if it is empty."""
+
+        return CELL_TYPES.get(int(self.grid[x, y]))
+
+    def state_codes(self):
+        """Return the cell code of every state."""
+
+        return self.grid[self.states[:, 0], self.states[:, 1]]
+
+    def terminal_values(self, J):
+        """Return the value of every terminal state given a reward table J keyed by cell type."""
+
+        values = np.zeros(len(CELL_TYPES) + 1)
+        for code, name in CELL_TYPES.items():
+            values[code] = J.get(name, 0)
+        return values[self.state_codes()[self.n_nonterminal_states:]]
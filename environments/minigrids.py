@@ -2,13 +2,21 @@ import numpy as np
 import matplotlib.pyplot as plt
 from gym.wrappers import OrderEnforcing
 from environments.grid import CustomEnv
+from environments.minigrid_compiler import CompiledMinigrid, GOAL, LEFT, RIGHT, FORWARD
 from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
 from frameworks.mdp import MDP
 from frameworks.lmdp import LMDP
 from frameworks.lmdp_transition import LMDP_transition
 import random
 
 
+def terminal_rewards(grid_size):
+    """Reward function for terminal states of a minigrid of the given size."""
+
+    return {"goal": 0, "lava": -grid_size*6}
+
+
 class Minigrid_MDP(MDP):
 
     DIR_TO_VEC = [
@@ -22,16 +30,16 @@ class Minigrid_MDP(MDP):
         np.array((0, -1)),
     ]
 
-    def __init__(self, grid_size = 14, objects = {}, map = None, dynamics = None, gamma = 0.95):
+    def __init__(self, grid_size = 14, objects = {}, map = None, dynamics = None, gamma = 0.95, model = None, seed = None):
         """Initialize the Minigrid MDP."""
 
         self.grid_size = grid_size
         self.n_orientations = 4
         self.actions = list(range(3))
-        self.J = {"goal": 0, "lava": -grid_size*6} # Determine reward function for terminal states
-        n_states, n_terminal_states = self._create_environment(grid_size, objects, map=map)
+        self.J = terminal_rewards(grid_size) # Determine reward function for terminal states
+        n_states, n_terminal_states = self._create_environment(grid_size, objects, map=map, model=model)
 
-        super().__init__(n_states = n_states, n_terminal_states = n_terminal_states, n_actions = len(self.actions), gamma = gamma, s0 = self.s0)
+        super().__init__(n_states = n_states, n_terminal_states = n_terminal_states, n_actions = len(self.actions), gamma = gamma, s0 = self.s0, seed = seed)
         self.n_cells = int(self.n_states / self.n_orientations)
 
         if dynamics is None:
@@ -41,70 +49,50 @@ class Minigrid_MDP(MDP):
             self.P = dynamics['P']
             self.R = dynamics['R']
 
-    def _create_environment(self, grid_size, objects, map=map):
+    def _create_environment(self, grid_size, objects, map=map, model=None):
         """Create the Minigrid environment."""
 
-        self.env = OrderEnforcing(CustomEnv(size=grid_size+2, objects=objects, map=map,render_mode="rgb_array"))
-        self.env.reset()
-
-        nonterminal_states = []
-        terminal_states = []
-        for x in range(1, self.env.grid.height):
-            for y in range(1, self.env.grid.width):
-                if self._is_valid_position(x, y):
-                    for o in range(4):
-                        state = (x, y, o)
-                        if self._is_terminal(state):
-                            terminal_states.append(state)
-                        else:
-                            nonterminal_states.append(state)
-
-        self.states = nonterminal_states + terminal_states
-        assert self.grid_size * self.grid_size - len(self.env.walls) == len(self.states) / self.n_orientations, "Invalid number of states"
+        # The gym environment is only created when rendering or stepping needs it
+        self.objects = objects
+        self.map = map
+        self._env = None
+
+        # Enumerate states and successors with array operations, unless a compiled layout is given (e.g. by ModelCache)
+        self.model = CompiledMinigrid(grid_size, objects, map=map, terminal_types=self.J.keys()) if model is None else model
+        self.states = [tuple(state) for state in self.model.states.tolist()]
+        assert self.grid_size * self.grid_size - len(self.model.walls) == len(self.states) / self.n_orientations, "Invalid number of states"
         self.state_to_index = {state: index for index, state in enumerate(self.states)}
-        self.s0 = self.state_to_index[(self.env.agent_start_pos[0], self.env.agent_start_pos[1], self.env.agent_start_dir)]
-        return len(self.states), len(terminal_states)
+        self.s0 = int(self.model.s0)
+        return self.model.n_states, self.model.n_states - self.model.n_nonterminal_states
 
     def _create_P(self):
         """Create the transition matrix for a deterministic MDP."""
 
-        for state in range(self.n_nonterminal_states):
-            for action in self.actions:
-                next_state = self._state_step(self.states[state], action)
-                self.P[state][action][self.state_to_index[next_state]] = 1.0
+        self.set_next_states(self.model.next_states)
 
     def _reward_function(self, uniform_reward=True):
         """Create the reward function for a deterministic MDP.
         
         :uniform_reward: Whether all actions lead to the same reward or it depends on their next state."""
 
-        for state in range(self.n_nonterminal_states):
-            for action in self.actions:
-                if uniform_reward:
-                    self.R[state][action] = -1.0
-                else:
-                    next_state = self._state_step(self.states[state], action)
-                    pos = self.env.grid.get(next_state[0], next_state[1])
-                    self.R[state][action] = -1.0 if pos is None or pos.type != "goal" else 0.0
+        if uniform_reward:
+            self.R[:self.n_nonterminal_states] = -1.0
+        else:
+            next_codes = self.model.state_codes()[self.model.next_states]
+            self.R[:self.n_nonterminal_states] = np.where(next_codes == GOAL, 0.0, -1.0)
         
-        for state in range(self.n_nonterminal_states, self.n_states):
-            self.R[state] = self.J[self._state_type(self.states[state])]
+        self.R[self.n_nonterminal_states:] = self.model.terminal_values(self.J)[:, np.newaxis]
 
 
     def _is_valid_position(self, x: int, y: int) -> bool:
         """Testing whether a coordinate is a valid location."""
 
-        return (
-            0 < x < self.env.width and
-            0 < y < self.env.height and
-            (self.env.grid.get(x, y) is None or self.env.grid.get(x, y).can_overlap())
-        )
+        return self.model.is_valid_position(x, y)
     
     def _state_type(self, state: tuple[int, int, int]) -> str:
         """Return the type of a state."""
 
-        pos = self.env.grid.get(state[0], state[1])
-        return pos.type if pos is not None else None
+        return self.model.cell_type(state[0], state[1])
     
     def _is_terminal(self, state: tuple[int, int, int]) -> bool:
         """Check if a state is terminal."""
@@ -128,13 +116,13 @@ class Minigrid_MDP(MDP):
         assert self._is_valid_position(x, y)
 
         # Transition left
-        if action == self.env.actions.left:
+        if action == LEFT:
             direction = (direction - 1) % 4
         # Transition right
-        elif action == self.env.actions.right:
+        elif action == RIGHT:
             direction = (direction + 1) % 4
         # Transition forward
-        elif action == self.env.actions.forward:
+        elif action == FORWARD:
             fwd_pos = np.array((x, y)) + self.DIR_TO_VEC[direction]
             if self._is_valid_position(*fwd_pos):
                 x, y = fwd_pos
@@ -145,6 +133,15 @@ class Minigrid_MDP(MDP):
 
         return x, y, direction
     
+    @property
+    def env(self):
+        """Gym environment used for rendering and stepping, created on first use."""
+
+        if self._env is None:
+            self._env = OrderEnforcing(CustomEnv(size=self.grid_size+2, objects=self.objects, map=self.map, render_mode="rgb_array"))
+            self._env.reset()
+        return self._env
+
     # Core Methods
 
     def reset(self, **kwargs):
@@ -180,15 +177,68 @@ class Minigrid_MDP(MDP):
         plt.imshow(image)
         plt.show()
     
-    def embedding_to_LMDP(self):
+    def embedding_to_LMDP(self, tol = 1e-5, method = "direct"):
         """Embed the Minigrid MDP into a Minigrid LMDP."""
 
-        lmdp, embedding_rmse = super().embedding_to_LMDP()
+        lmdp, embedding_rmse = super().embedding_to_LMDP(tol=tol, method=method)
         dynamics = {'P0': lmdp.P0, 'R': lmdp.R}
-        objects = {'walls': self.env.walls, 'lavas': self.env.lavas}
-        lmdp_minigrid = Minigrid_LMDP(self.grid_size, map=self.env.map, objects=objects, dynamics = dynamics)
+        objects = {'walls': self.model.walls, 'lavas': self.model.lavas}
+        lmdp_minigrid = Minigrid_LMDP(self.grid_size, map=self.map, objects=objects, dynamics = dynamics)
         return lmdp_minigrid, embedding_rmse
 
+    def goal_value_table(self, goals = None, dtype = np.float64, filename = None, batch_size = 256):
+        """Optimal value of every state when each of the given cells is the only goal, assuming the layout dynamics and step reward -1.
+
+        :param goals: (n_goals, 2) array of goal cells, by default all the cells that are not walls or lava.
+        :param dtype: Data type of the table, np.float32 halves its size.
+        :param filename: If given, the table is written to a memory-mapped .npy file at this path.
+        :param batch_size: Number of goals searched at once.
+        :return: The (n_goals, 2) goal cells and the (n_goals, n_states) value table over the states of the MDP."""
+
+        # The table is built from the layout alone, e.g. models built from embedded dynamics do not qualify
+        assert (self.R[:self.n_nonterminal_states] == -1).all(), "goal_value_table assumes the uniform step reward of -1"
+        assert np.array_equal(self.next_state_table(), self.model.next_states), "goal_value_table assumes the deterministic layout dynamics"
+
+        goal_free = CompiledMinigrid(self.grid_size, self.objects, map=self.map, terminal_types=("lava",))
+        n, n_states = goal_free.n_nonterminal_states, goal_free.n_states
+        if goals is None:
+            goals = np.unique(goal_free.states[:n, :2], axis=0)
+        goals = np.asarray(goals, dtype=int).reshape(-1, 2)
+        goal_states = goal_free.state_index[goals[:, 0], goals[:, 1]]
+        assert (goal_states >= 0).all() and (goal_states < n).all(), "Goals must be cells that are not walls or lava"
+
+        if filename is None:
+            table = np.empty((len(goals), self.n_states), dtype=dtype)
+        else:
+            table = np.lib.format.open_memmap(filename, mode='w+', dtype=dtype, shape=(len(goals), self.n_states))
+
+        def discounted_steps(d):
+            return d if self.gamma == 1 else (1 - self.gamma ** d) / (1 - self.gamma)
+
+        # Reverse successor graph, from next states to the states leading to them
+        rows = goal_free.next_states.ravel()
+        cols = np.repeat(np.arange(n), goal_free.next_states.shape[1])
+        lava_distance = dijkstra(csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(n_states, n_states)), indices=np.arange(n, n_states), unweighted=True, min_only=True) if n < n_states else np.full(n_states, np.inf)
+        lava_value = -discounted_steps(lava_distance) + self.gamma ** lava_distance * self.J["lava"]
+        best_value = np.maximum(lava_value, -discounted_steps(np.inf))
+
+        # Columns of the table in the state order of the MDP
+        order = goal_free.state_index[self.model.states[:, 0], self.model.states[:, 1], self.model.states[:, 2]]
+
+        for start in range(0, len(goals), batch_size):
+            batch = goal_states[start:start + batch_size]
+            k = len(batch)
+            sources = n_states + np.repeat(np.arange(k), 4)
+            graph = csr_matrix((np.ones(len(rows) + 4 * k), (np.concatenate((rows, sources)), np.concatenate((cols, batch.ravel())))), shape=(n_states + k, n_states + k))
+            goal_distance = dijkstra(graph, indices=n_states + np.arange(k), unweighted=True)[:, :n_states] - 1
+
+            values = np.maximum(-discounted_steps(goal_distance) + self.gamma ** goal_distance * self.J["goal"], best_value)
+            values[np.arange(k)[:, np.newaxis], batch] = self.J["goal"]
+            values[:, n:] = self.J["lava"]
+            table[start:start + k] = values[:, order]
+
+        return goals, table
+
     # Auxiliary Methods
     
     def print_attributes(self):
@@ -214,15 +264,15 @@ class Minigrid_LMDP(LMDP):
         np.array((0, -1)),
     ]
 
-    def __init__(self, grid_size = 14, objects = {}, map=None, dynamics = None, lmbda = 1):
+    def __init__(self, grid_size = 14, objects = {}, map=None, dynamics = None, lmbda = 1, model = None, seed = None):
         """Initialize the minigrid environment."""
 
         self.grid_size = grid_size
         self.n_orientations = 4
-        self.J = {"goal": 0, "lava": -grid_size*6} # Determine reward function for terminal states
-        n_states, n_terminal_states = self._create_environment(grid_size, objects, map=map)
+        self.J = terminal_rewards(grid_size) # Determine reward function for terminal states
+        n_states, n_terminal_states = self._create_environment(grid_size, objects, map=map, model=model)
         
-        super().__init__(n_states = n_states, n_terminal_states = n_terminal_states, lmbda=lmbda, s0=self.s0)
+        super().__init__(n_states = n_states, n_terminal_states = n_terminal_states, lmbda=lmbda, s0=self.s0, seed=seed)
         self.n_cells = int(self.n_states / self.n_orientations)
         
         if dynamics is None:
@@ -232,64 +282,47 @@ class Minigrid_LMDP(LMDP):
             self.P0 = dynamics['P0']
             self.R = dynamics['R']
 
-    def _create_environment(self, grid_size, objects, map=map):
+    def _create_environment(self, grid_size, objects, map=map, model=None):
         """Create the environment for the minigrid."""
 
-        self.env = OrderEnforcing(CustomEnv(size=grid_size+2, objects=objects, map=map, render_mode="rgb_array"))
-        self.env.reset()
-        
-        nonterminal_states = []
-        terminal_states = []
-        for x in range(1, self.env.grid.height):
-            for y in range(1, self.env.grid.width):
-                if self._is_valid_position(x, y):
-                    for o in range(4):
-                        state = (x, y, o)
-                        if self._is_terminal(state):
-                            terminal_states.append(state)
-                        else:
-                            nonterminal_states.append(state)
-
-        self.states = nonterminal_states + terminal_states
-        assert self.grid_size * self.grid_size - len(self.env.walls) == len(self.states) / self.n_orientations, "Invalid number of states"
+        # The gym environment is only created when rendering or stepping needs it
+        self.objects = objects
+        self.map = map
+        self._env = None
+
+        # Enumerate states and successors with array operations, unless a compiled layout is given (e.g. by ModelCache)
+        self.model = CompiledMinigrid(grid_size, objects, map=map, terminal_types=self.J.keys()) if model is None else model
+        self.states = [tuple(state) for state in self.model.states.tolist()]
+        assert self.grid_size * self.grid_size - len(self.model.walls) == len(self.states) / self.n_orientations, "Invalid number of states"
         self.state_to_index = {state: index for index, state in enumerate(self.states)}
-        self.s0 = self.state_to_index[(self.env.agent_start_pos[0], self.env.agent_start_pos[1], self.env.agent_start_dir)]
-        return len(self.states), len(terminal_states)
+        self.s0 = int(self.model.s0)
+        return self.model.n_states, self.model.n_states - self.model.n_nonterminal_states
 
     def _create_P0(self, sparse = True):
         """Create the uncontrolled transition probabilities matrix for a stochastic LMDP."""
 
-        transitions = [self.env.actions.left, self.env.actions.right, self.env.actions.forward]
-        for state in range(self.n_nonterminal_states):
-            for t in transitions:
-                next_state = self.state_step(self.states[state], t)
-                self.P0[state][self.state_to_index[next_state]] += 1/len(transitions)
-        if sparse:
-            self.P0 = csr_matrix(self.P0)
+        next_states = self.model.next_states
+        # Duplicated next states are summed up when building the sparse matrix
+        rows = np.repeat(np.arange(self.n_nonterminal_states), next_states.shape[1])
+        self.P0 = csr_matrix((np.full(next_states.size, 1/next_states.shape[1]), (rows, next_states.flatten())), shape=self.P0.shape)
+        if not sparse:
+            self.P0 = self.P0.toarray()
 
     def _reward_function(self):
         """Create the reward function for the minigrid environment."""
 
-        for state in range(self.n_nonterminal_states):
-            self.R[state] = -1.0
-
-        for state in range(self.n_nonterminal_states, self.n_states):
-            self.R[state] = self.J[self._state_type(self.states[state])]
+        self.R[:self.n_nonterminal_states] = -1.0
+        self.R[self.n_nonterminal_states:] = self.model.terminal_values(self.J)
 
     def _is_valid_position(self, x: int, y: int) -> bool:
         """Testing whether a coordinate is a valid location."""
 
-        return (
-            0 < x < self.env.width and
-            0 < y < self.env.height and
-            (self.env.grid.get(x, y) is None or self.env.grid.get(x, y).can_overlap())
-        )
+        return self.model.is_valid_position(x, y)
     
     def _state_type(self, state: tuple[int, int, int]) -> str:
         """Return the type of a state."""
 
-        pos = self.env.grid.get(state[0], state[1])
-        return pos.type if pos is not None else None
+        return self.model.cell_type(state[0], state[1])
     
     def _is_terminal(self, state: tuple[int, int, int]) -> bool:
         """Check if a state is terminal."""
@@ -312,13 +345,13 @@ class Minigrid_LMDP(LMDP):
         assert self._is_valid_position(x, y)
 
         # Transition left
-        if action == self.env.actions.left:
+        if action == LEFT:
             direction = (direction - 1) % 4
         # Transition right
-        elif action == self.env.actions.right:
+        elif action == RIGHT:
             direction = (direction + 1) % 4
         # Transition forward
-        elif action == self.env.actions.forward:
+        elif action == FORWARD:
             fwd_pos = np.array((x, y)) + self.DIR_TO_VEC[direction]
             if self._is_valid_position(*fwd_pos):
                 x, y = fwd_pos
@@ -329,6 +362,15 @@ class Minigrid_LMDP(LMDP):
 
         return x, y, direction
     
+    @property
+    def env(self):
+        """Gym environment used for rendering and stepping, created on first use."""
+
+        if self._env is None:
+            self._env = OrderEnforcing(CustomEnv(size=self.grid_size+2, objects=self.objects, map=self.map, render_mode="rgb_array"))
+            self._env.reset()
+        return self._env
+
     # Core Methods
 
     def reset(self, **kwargs):
@@ -369,8 +411,8 @@ class Minigrid_LMDP(LMDP):
 
         mdp, embedding_mse = super().embedding_to_MDP()
         dynamics = {'P': mdp.P, 'R': mdp.R}
-        objects = {'walls': self.env.walls, 'lavas': self.env.lavas}
-        mdp_minigrid = Minigrid_MDP(self.grid_size, map=self.env.map, objects=objects, dynamics = dynamics)
+        objects = {'walls': self.model.walls, 'lavas': self.model.lavas}
+        mdp_minigrid = Minigrid_MDP(self.grid_size, map=self.map, objects=objects, dynamics = dynamics)
         return mdp_minigrid, embedding_mse
     
     # Auxiliary Methods
@@ -397,15 +439,15 @@ class Minigrid_LMDP_transition(LMDP_transition):
         np.array((0, -1)),
     ]
 
-    def __init__(self, grid_size = 14, objects = {}, map=None, dynamics = None, lmbda = 1):
+    def __init__(self, grid_size = 14, objects = {}, map=None, dynamics = None, lmbda = 1, model = None, seed = None):
         """Initialize the minigrid environment."""
 
         self.grid_size = grid_size
         self.n_orientations = 4
-        self.RJ = {"goal": 0, "lava": -grid_size*6} # Determine reward function for terminal states
-        n_states, n_terminal_states = self._create_environment(grid_size, objects, map=map)
+        self.RJ = terminal_rewards(grid_size) # Determine reward function for terminal states
+        n_states, n_terminal_states = self._create_environment(grid_size, objects, map=map, model=model)
         
-        super().__init__(n_states = n_states, n_terminal_states = n_terminal_states, lmbda=lmbda, s0=self.s0)
+        super().__init__(n_states = n_states, n_terminal_states = n_terminal_states, lmbda=lmbda, s0=self.s0, seed=seed)
         self.n_cells = int(self.n_states / self.n_orientations)
         
         if dynamics is None:
@@ -414,71 +456,56 @@ class Minigrid_LMDP_transition(LMDP_transition):
         else:
             self.P0 = dynamics['P0']
             self.R = dynamics['R']
+            self.J = dynamics['J'] if 'J' in dynamics else self.model.terminal_values(self.RJ)
 
-    def _create_environment(self, grid_size, objects, map=map):
+    def _create_environment(self, grid_size, objects, map=map, model=None):
         """Create the environment for the minigrid."""
 
-        self.env = OrderEnforcing(CustomEnv(size=grid_size+2, objects=objects, map=map, render_mode="rgb_array"))
-        self.env.reset()
-        
-        nonterminal_states = []
-        terminal_states = []
-        for x in range(1, self.env.grid.height):
-            for y in range(1, self.env.grid.width):
-                if self._is_valid_position(x, y):
-                    for o in range(4):
-                        state = (x, y, o)
-                        if self._is_terminal(state):
-                            terminal_states.append(state)
-                        else:
-                            nonterminal_states.append(state)
-
-        self.states = nonterminal_states + terminal_states
-        assert self.grid_size * self.grid_size - len(self.env.walls) == len(self.states) / self.n_orientations, "Invalid number of states"
+        # The gym environment is only created when rendering or stepping needs it
+        self.objects = objects
+        self.map = map
+        self._env = None
+
+        # Enumerate states and successors with array operations, unless a compiled layout is given (e.g. by ModelCache)
+        self.model = CompiledMinigrid(grid_size, objects, map=map, terminal_types=self.RJ.keys()) if model is None else model
+        self.states = [tuple(state) for state in self.model.states.tolist()]
+        assert self.grid_size * self.grid_size - len(self.model.walls) == len(self.states) / self.n_orientations, "Invalid number of states"
         self.state_to_index = {state: index for index, state in enumerate(self.states)}
-        self.s0 = self.state_to_index[(self.env.agent_start_pos[0], self.env.agent_start_pos[1], self.env.agent_start_dir)]
-        return len(self.states), len(terminal_states)
+        self.s0 = int(self.model.s0)
+        return self.model.n_states, self.model.n_states - self.model.n_nonterminal_states
 
     def _create_P0(self, sparse = True):
         """Create the uncontrolled transition probabilities matrix for a stochastic LMDP."""
 
-        transitions = [self.env.actions.left, self.env.actions.right, self.env.actions.forward]
-        for state in range(self.n_nonterminal_states):
-            for t in transitions:
-                next_state = self.state_step(self.states[state], t)
-                self.P0[state][self.state_to_index[next_state]] += 1/len(transitions)
-        if sparse:
-            self.P0 = csr_matrix(self.P0)
+        next_states = self.model.next_states
+        # Duplicated next states are summed up when building the sparse matrix
+        rows = np.repeat(np.arange(self.n_nonterminal_states), next_states.shape[1])
+        self.P0 = csr_matrix((np.full(next_states.size, 1/next_states.shape[1]), (rows, next_states.flatten())), shape=self.P0.shape)
+        if not sparse:
+            self.P0 = self.P0.toarray()
 
     def _reward_function(self, sparse=True):
         """Create the reward functions for the minigrid environment."""
 
-        transitions = [self.env.actions.left, self.env.actions.right, self.env.actions.forward]
-        for state in range(self.n_nonterminal_states):
-            for t in transitions:
-                next_state = self.state_step(self.states[state], t)
-                self.R[state, self.state_to_index[next_state]] = -1.0
+        next_states = self.model.next_states
+        rows = np.repeat(np.arange(self.n_nonterminal_states), next_states.shape[1])
+        self.R = csr_matrix((np.ones(next_states.size), (rows, next_states.flatten())), shape=self.R.shape)
+        self.R.data[:] = -1.0
         
-        for state in range(self.n_nonterminal_states, self.n_states):
-            self.J[state-self.n_nonterminal_states] = self.RJ[self._state_type(self.states[state])]
+        self.J = self.model.terminal_values(self.RJ)
         
-        if sparse:
-            self.R = csr_matrix(self.R)
+        if not sparse:
+            self.R = self.R.toarray()
 
     def _is_valid_position(self, x: int, y: int) -> bool:
         """Testing whether a coordinate is a valid location."""
 
-        return (
-            0 < x < self.env.width and
-            0 < y < self.env.height and
-            (self.env.grid.get(x, y) is None or self.env.grid.get(x, y).can_overlap())
-        )
+        return self.model.is_valid_position(x, y)
     
     def _state_type(self, state: tuple[int, int, int]) -> str:
         """Return the type of a state."""
 
-        pos = self.env.grid.get(state[0], state[1])
-        return pos.type if pos is not None else None
+        return self.model.cell_type(state[0], state[1])
     
     def _is_terminal(self, state: tuple[int, int, int]) -> bool:
         """Check if a state is terminal."""
@@ -501,13 +528,13 @@ class Minigrid_LMDP_transition(LMDP_transition):
         assert self._is_valid_position(x, y)
 
         # Transition left
-        if action == self.env.actions.left:
+        if action == LEFT:
             direction = (direction - 1) % 4
         # Transition right
-        elif action == self.env.actions.right:
+        elif action == RIGHT:
             direction = (direction + 1) % 4
         # Transition forward
-        elif action == self.env.actions.forward:
+        elif action == FORWARD:
             fwd_pos = np.array((x, y)) + self.DIR_TO_VEC[direction]
             if self._is_valid_position(*fwd_pos):
                 x, y = fwd_pos
@@ -518,6 +545,15 @@ class Minigrid_LMDP_transition(LMDP_transition):
 
         return x, y, direction
     
+    @property
+    def env(self):
+        """Gym environment used for rendering and stepping, created on first use."""
+
+        if self._env is None:
+            self._env = OrderEnforcing(CustomEnv(size=self.grid_size+2, objects=self.objects, map=self.map, render_mode="rgb_array"))
+            self._env.reset()
+        return self._env
+
     # Core Methods
 
     def reset(self, **kwargs):
@@ -558,8 +594,8 @@ class Minigrid_LMDP_transition(LMDP_transition):
 
         mdp, embedding_mse = super().embedding_to_MDP()
         dynamics = {'P': mdp.P, 'R': mdp.R}
-        objects = {'walls': self.env.walls, 'lavas': self.env.lavas}
-        mdp_minigrid = Minigrid_MDP(self.grid_size, map=self.env.map, objects=objects, dynamics = dynamics)
+        objects = {'walls': self.model.walls, 'lavas': self.model.lavas}
+        mdp_minigrid = Minigrid_MDP(self.grid_size, map=self.map, objects=objects, dynamics = dynamics)
         return mdp_minigrid, embedding_mse
     
     # Auxiliary Methods
@@ -1,12 +1,14 @@
 import numpy as np
 from frameworks.lmdp import LMDP
 from frameworks.mdp import MDP
+from scipy.sparse import csr_matrix
 
 class SimpleGrid_LMDP(LMDP):
 
     def __init__(self, size = 2):
         super().__init__(size * size, 1)
         self.states = []
+        P0 = np.zeros((self.n_nonterminal_states, self.n_states))
         
         # construct transition probabilities
         for x in range(size):
@@ -14,24 +16,26 @@ class SimpleGrid_LMDP(LMDP):
                 state = x * size + y
                 if state < self.n_nonterminal_states:
                     if x > 0:
-                        self.P0[state][(x - 1) * size + y] += 1
+                        P0[state][(x - 1) * size + y] += 1
                     else:
-                        self.P0[state][state] += 1
+                        P0[state][state] += 1
                     if x + 1 < size:
-                        self.P0[state][(x + 1) * size + y] += 1
+                        P0[state][(x + 1) * size + y] += 1
                     else:
-                        self.P0[state][state] += 1
+                        P0[state][state] += 1
                     if y > 0:
-                        self.P0[state][x * size + y - 1] += 1
+                        P0[state][x * size + y - 1] += 1
                     else:
-                        self.P0[state][state] += 1
+                        P0[state][state] += 1
                     if y + 1 < size:
-                        self.P0[state][x * size + y + 1] += 1
+                        P0[state][x * size + y + 1] += 1
                     else:
-                        self.P0[state][state] += 1
+                        P0[state][state] += 1
                     self.states.append((x, y))
 
-                    self.P0[state][:] /= np.sum(self.P0[state])
+                    P0[state][:] /= np.sum(P0[state])
+
+        self.P0 = csr_matrix(P0)
 
         # construct reward function
         self.R[0:self.n_nonterminal_states] = -1
@@ -45,6 +49,7 @@ class SimpleGrid_MDP(MDP):
     def __init__(self, size = 2):
         super().__init__(size * size, 1, 4)
         self.states = []
+        next_states = np.zeros((self.n_nonterminal_states, self.n_actions), dtype=int)
         
         # construct transition probabilities
         for x in range(size):
@@ -52,21 +57,23 @@ class SimpleGrid_MDP(MDP):
                 state = x * size + y
                 if state < self.n_nonterminal_states:
                     if x > 0:
-                        self.P[state][0][(x - 1) * size + y] = 1
+                        next_states[state][0] = (x - 1) * size + y
                     else:
-                        self.P[state][0][state] = 1
+                        next_states[state][0] = state
                     if x + 1 < size:
-                        self.P[state][1][(x + 1) * size + y] = 1
+                        next_states[state][1] = (x + 1) * size + y
                     else:
-                        self.P[state][1][state] = 1
+                        next_states[state][1] = state
                     if y > 0:
-                        self.P[state][2][x * size + y - 1] = 1
+                        next_states[state][2] = x * size + y - 1
                     else:
-                        self.P[state][2][state] = 1
+                        next_states[state][2] = state
                     if y + 1 < size:
-                        self.P[state][3][x * size + y + 1] = 1
+                        next_states[state][3] = x * size + y + 1
                     else:
-                        self.P[state][3][state] = 1
+                        next_states[state][3] = state
+
+        self.set_next_states(next_states)
 
         # construct reward function
         self.R[0:self.n_nonterminal_states][:] = -1
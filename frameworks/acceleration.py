@@ -0,0 +1,60 @@
+import numpy as np
+
+
+def anderson(T, x, memory = 5, epsilon = 1e-10, safeguard = 2, cooldown = 5):
+    """Safeguarded Anderson acceleration (type II) of the fixed point iteration x <- T(x).
+
+    Every step mixes the last evaluations of T with the coefficients that minimize the least squares combination of
+    the last residuals T(x) - x, over a window of the given memory. Accelerated steps whose (max norm) residual exceeds
+    safeguard times the smallest residual seen so far are rejected in favour of the plain step T(x), restarting the
+    window, and the next cooldown steps are plain ones. Convergence is tested as in the plain solvers: the span of the
+    residual, with the (zero) residual of the terminal states included, must not exceed epsilon.
+
+    :return: The accepted iterate and the number of evaluations of T performed."""
+
+    def span(f):
+        return max(f.max(), 0) - min(f.min(), 0)
+
+    # Ring buffers of the last differences of residuals and evaluations, and the Gram matrix of the residual ones
+    dF = np.empty((memory, len(x)))
+    dG = np.empty((memory, len(x)))
+    gram = np.empty((memory, memory))
+    k = head = plain = 0
+
+    fx = T(x)
+    f = fx - x
+    n_steps = 1
+    best = np.abs(f).max()
+
+    while span(f) > epsilon:
+        accelerated = k > 0 and plain == 0
+        plain = max(plain - 1, 0)
+        if accelerated:
+            # Normal equations of the least squares problem, lightly regularized
+            H = gram[:k, :k]
+            coefficients = np.linalg.solve(H + 1e-12 * np.trace(H) * np.eye(k), dF[:k] @ f)
+            candidate = fx - coefficients @ dG[:k]
+        else:
+            candidate = fx
+        fc = T(candidate)
+        n_steps += 1
+        rc = fc - candidate
+
+        if accelerated and not np.abs(rc).max() <= safeguard * best:
+            # Safeguard: take the plain step instead and restart the window
+            k = head = 0
+            plain = cooldown
+            candidate, fc = fx, T(fx)
+            n_steps += 1
+            rc = fc - candidate
+        else:
+            np.subtract(rc, f, out=dF[head])
+            np.subtract(fc, fx, out=dG[head])
+            k = min(k + 1, memory)
+            gram[head, :k] = gram[:k, head] = dF[:k] @ dF[head]
+            head = (head + 1) % memory
+
+        best = min(best, np.abs(rc).max())
+        x, fx, f = candidate, fc, rc
+
+    return x, n_steps
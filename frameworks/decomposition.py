@@ -0,0 +1,48 @@
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+from frameworks.sampling import row_positions
+
+
+def component_layers(rows, cols, n_nonterminal_states):
+    """Group the nonterminal states into layers of strongly connected components of the transition graph, in solving order.
+
+    Every component of a layer only leads to components of earlier layers (or to itself), so once the earlier layers
+    are solved the components of a layer can be solved together and independently of the later layers.
+
+    :param rows: Source states of the transition graph edges (terminal successors are ignored).
+    :param cols: Next states of the transition graph edges.
+    :return: The list of layers, each one as a tuple of its states and whether any of its components contains a cycle
+        (a single backup is exact on acyclic layers)."""
+
+    n = n_nonterminal_states
+    inside = cols < n
+    rows, cols = rows[inside], cols[inside]
+    graph = csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(n, n))
+    n_components, labels = connected_components(graph, directed=True, connection='strong')
+
+    cyclic = np.bincount(labels, minlength=n_components) > 1
+    cyclic[labels[rows[rows == cols]]] = True
+
+    # Condensation of the graph, in which components are peeled off layer by layer starting from the sinks
+    cross = labels[rows] != labels[cols]
+    condensation = csr_matrix((np.ones(cross.sum()), (labels[rows][cross], labels[cols][cross])), shape=(n_components, n_components))
+    out_degree = np.diff(condensation.indptr)
+    predecessors = condensation.T.tocsr()
+
+    layer_of = np.empty(n_components, dtype=int)
+    layer = np.flatnonzero(out_degree == 0)
+    n_layers = 0
+    while len(layer):
+        layer_of[layer] = n_layers
+        n_layers += 1
+        preds = predecessors.indices[row_positions(predecessors.indptr, layer)[0]]
+        np.subtract.at(out_degree, preds, 1)
+        layer = np.unique(preds[out_degree[preds] == 0])
+
+    state_layers = layer_of[labels]
+    order = np.argsort(state_layers, kind='stable')
+    bounds = np.searchsorted(state_layers[order], np.arange(n_layers + 1))
+    layer_cyclic = np.zeros(n_layers, dtype=bool)
+    layer_cyclic[layer_of[cyclic]] = True
+    return [(order[bounds[i]:bounds[i + 1]], layer_cyclic[i]) for i in range(n_layers)]
@@ -0,0 +1,60 @@
+import numpy as np
+from scipy.sparse.linalg import splu, spilu, gmres, bicgstab, LinearOperator
+
+try:
+    # In-place CSR product kernel of scipy, which is not part of its public API
+    from scipy.sparse._sparsetools import csr_matvec as _csr_matvec
+except ImportError:
+    _csr_matvec = None
+
+
+def csr_matvec(A, x, y):
+    """Accumulate the product of a CSR matrix and a vector into a preallocated buffer, y += A @ x.
+    Uses the in-place kernel of scipy when available, and the public product otherwise."""
+
+    if _csr_matvec is None:
+        y += A @ x
+    else:
+        _csr_matvec(A.shape[0], A.shape[1], A.indptr, A.indices, A.data, x, y)
+    return y
+
+
+def solve_sparse(A, b, method = "direct", epsilon = 1e-10):
+    """Solve the sparse linear system A x = b.
+
+    :param method: 'direct' (sparse LU factorization) or 'gmres'/'bicgstab' (ILU preconditioned Krylov methods, stopping on a relative residual of epsilon).
+    :return: The solution and the number of iterations performed (1 for the direct method)."""
+
+    A = A.tocsc()
+
+    if method == "direct":
+        return splu(A).solve(b), 1
+
+    assert method in ("gmres", "bicgstab"), f"Invalid method {method}"
+    M = LinearOperator(A.shape, spilu(A).solve)
+    n_steps = 0
+    def count_iterations(_):
+        nonlocal n_steps
+        n_steps += 1
+    if method == "gmres":
+        x, info = gmres(A, b, rtol=epsilon, atol=0, M=M, callback=count_iterations, callback_type='pr_norm')
+    else:
+        x, info = bicgstab(A, b, rtol=epsilon, atol=0, M=M, callback=count_iterations)
+    if info != 0:
+        raise RuntimeError(f"{method} did not converge (info = {info})")
+    return x, n_steps
+
+
+def lstsq_batch(A, b, rcond = 1e-15):
+    """Minimum norm least squares solutions of a stack of small dense systems A[i] x[i] = b[i], through one batched
+    SVD instead of a pseudo-inverse per system. Singular values below rcond times the largest one of their system are
+    treated as zero, as in np.linalg.pinv.
+
+    :param A: (k, m, n) stack of matrices.
+    :param b: (k, m) stack of right-hand sides.
+    :return: The (k, n) stack of solutions."""
+
+    U, s, Vt = np.linalg.svd(A, full_matrices=False)
+    cutoff = rcond * s.max(axis=1, keepdims=True)
+    s_inv = np.divide(1, s, out=np.zeros_like(s), where=s > cutoff)
+    return np.einsum('kji,kj->ki', Vt, s_inv * np.einsum('kji,kj->ki', U, b))
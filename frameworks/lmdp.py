@@ -1,52 +1,353 @@
+import warnings
 import numpy as np
 from frameworks.mdp import MDP
-from scipy.sparse import csr_matrix, isspmatrix_csr
+from scipy.sparse import csr_matrix, isspmatrix_csr, identity
+from scipy.special import xlogy
+from frameworks.sampling import TransitionSampler
+from frameworks.decomposition import component_layers
+from frameworks.linalg import solve_sparse, csr_matvec
+from frameworks.acceleration import anderson
 
 
 class LMDP:
-    def __init__(self, n_states, n_terminal_states, lmbda = 1, s0 = 0):
+    # Number of transition matrices whose next state samplers are kept
+    n_cached_samplers = 8
+
+    def __init__(self, n_states, n_terminal_states, lmbda = 1, s0 = 0, seed = None):
         self.n_states = n_states
         self.n_nonterminal_states = n_states - n_terminal_states
-        self.P0 = np.zeros((self.n_nonterminal_states, n_states))
+        self.P0 = csr_matrix((self.n_nonterminal_states, n_states))
         self.R = np.zeros(n_states) # Assuming terminal states are at the end of the state space
         self.s0 = s0
         self.lmbda = lmbda
+        self.rng = np.random.default_rng(seed)
+        self._samplers = {}
+        self._terminal_basis = None
+
+    @property
+    def P0(self):
+        return self._P0
+
+    @P0.setter
+    def P0(self, P0):
+        # The cached terminal basis depends on P0, R and lambda
+        self._P0 = P0
+        self._terminal_basis = None
+
+    @property
+    def R(self):
+        return self._R
+
+    @R.setter
+    def R(self, R):
+        self._R = R
+        self._terminal_basis = None
+
+    @property
+    def lmbda(self):
+        return self._lmbda
+
+    @lmbda.setter
+    def lmbda(self, lmbda):
+        self._lmbda = lmbda
+        self._terminal_basis = None
 
     def act(self, current_state, P):
         """Transition function."""
 
-        # Check if the transition matrix is sparse 
-        if isspmatrix_csr(P):
-            next_state = np.random.choice(P[current_state].indices, p=P[current_state].data) # Using sparse matrix
-        else:
-            next_state = np.random.choice(self.n_states, p=P[current_state])
+        next_state = self.sampler(P).sample(current_state)
         reward = self.R[next_state]
         terminal = next_state >= self.n_nonterminal_states
         return next_state, reward, terminal
     
-    def power_iteration(self, lmbda = None, epsilon = 1e-10):
-        """Power iteration algorithm to compute the optimal Z function."""
+    def sampler(self, P):
+        """Return the next state sampler of a transition matrix (P0 or Pu), built once per matrix.
+        Rows of P modified in place must be refreshed with the update_rows method of the sampler."""
+
+        # Keyed by id(P): the sampler keeps a reference to P, so the id is not reused while the entry exists
+        sampler = self._samplers.get(id(P))
+        if sampler is None or sampler.P is not P:
+            if len(self._samplers) >= self.n_cached_samplers:
+                del self._samplers[next(iter(self._samplers))]
+            sampler = self._samplers[id(P)] = TransitionSampler(P, self.rng)
+        return sampler
+
+    def power_iteration(self, lmbda = None, epsilon = 1e-10, decompose = False, accelerate = False, Z0 = None):
+        """Power iteration algorithm to compute the optimal Z function.
+
+        The reward scaling is folded into a single CSR operator, each sweep Z_N <- G_NN Z_N + G_NT Z_T writes into
+        preallocated buffers, and convergence is tested on the ratio TZ / Z, since the span of V = lmbda * log(Z)
+        differences equals lmbda * (log(max ratio) - log(min ratio)).
+
+        :param decompose: Iterate one layer of strongly connected components of P0 at a time, from the ones closest to
+            the terminal states (see power_iteration_by_components).
+        :param accelerate: Apply safeguarded Anderson acceleration to the desirability operator (see power_iteration_anderson).
+        :param Z0: Initial Z values of all states (warm start), only the nonterminal ones are used. Defaults to ones."""
 
         lmbda = self.lmbda if lmbda is None else lmbda
 
-        P0 = self.P0 if isspmatrix_csr(self.P0) else csr_matrix(self.P0)
-        
-        #Z = np.concatenate((np.ones(self.n_nonterminal_states), np.exp(self.R[self.n_nonterminal_states:] / lmbda)))
-        Z = np.ones(self.n_states)
-        V_diff = np.arange(self.n_states)
+        G, ZT = self._desirability_operator(lmbda)
+        if decompose:
+            return self.power_iteration_by_components(G, ZT, lmbda, epsilon)
+        if accelerate:
+            return self.power_iteration_anderson(G, ZT, lmbda, epsilon)
+        return self.power_iteration_sweeps(G, ZT, lmbda, epsilon, Z0)
+
+    def power_iteration_sweeps(self, G, ZT, lmbda, epsilon = 1e-10, Z0 = None):
+        """Power iteration sweeps of power_iteration over a given desirability operator G and terminal Z values, so
+        callers solving a family of related problems can reuse one operator (see _desirability_operator).
+
+        :return: The Z function and the number of sweeps performed."""
+
+        n = self.n_nonterminal_states
+        G_N = G[:, :n]
+        G_T = G[:, n:]
+
+        # By default iterate from Z = 1 on all states, so the first sweep sees unit terminal values
+        Z = np.ones(n) if Z0 is None else np.array(Z0[:n], dtype=float)
+        TZ = np.empty(n)
+        ratio = np.empty(n)
+        b = G_T @ ZT
+        b_first = G_T @ np.ones(len(ZT)) if Z0 is None else b
+        # The first sweep moves the terminal Z values from 1 to ZT, afterwards their value difference is 0
+        terminal_bounds = (ZT.max(), ZT.min()) if Z0 is None else (1.0, 1.0)
         n_steps = 0
-        
-        G = csr_matrix(np.diag(np.exp(self.R[:self.n_nonterminal_states] / lmbda)))
-        ZT = np.exp(self.R[self.n_nonterminal_states:] / lmbda)
+        span = np.inf
 
-        while max(V_diff) - min(V_diff) > epsilon:
-            TZ = G @ P0 @ Z
-            TZ = np.concatenate((TZ, ZT))
-            V_diff = self.Z_to_V(TZ) - self.Z_to_V(Z)
-            Z = TZ
-            n_steps += 1
+        with np.errstate(divide='ignore', invalid='ignore'):
+            while span > epsilon:
+                np.copyto(TZ, b_first if n_steps == 0 else b)
+                csr_matvec(G_N, Z, TZ) # TZ += G_NN @ Z
+                np.divide(TZ, Z, out=ratio)
+                # States whose Z underflowed to 0 give 0/0 and are skipped
+                ratio_max = max(np.nanmax(ratio), terminal_bounds[0])
+                ratio_min = min(np.nanmin(ratio), terminal_bounds[1])
+                span = lmbda * (np.log(ratio_max) - np.log(ratio_min))
+                terminal_bounds = (1.0, 1.0)
+                Z, TZ = TZ, Z
+                n_steps += 1
+
+        return np.concatenate((Z, ZT)), n_steps
+
+    def power_iteration_batch(self, lmbdas, epsilon = 1e-10):
+        """Power iteration for several values of lambda, solved in increasing order with each one warm-started from the
+        value function of the previous one, Z0 = exp(V / lmbda), as V changes smoothly with lambda.
+
+        :return: The (n_states, len(lmbdas)) matrix of Z functions and the number of iterations of every lambda."""
+
+        lmbdas = np.asarray(lmbdas, dtype=float)
+        Z = np.empty((self.n_states, len(lmbdas)))
+        n_steps = np.zeros(len(lmbdas), dtype=int)
+        V = None
+
+        with np.errstate(divide='ignore'):
+            for i in np.argsort(lmbdas):
+                Z0 = None if V is None else np.exp(V / lmbdas[i])
+                Z[:, i], n_steps[i] = self.power_iteration(lmbdas[i], epsilon, Z0=Z0)
+                V = self.Z_to_V(Z[:, i], lmbdas[i])
 
         return Z, n_steps
+
+    def power_iteration_log(self, lmbda = None, epsilon = 1e-10, dtype = np.float64):
+        """Power iteration in the log domain, on log Z = V / lmbda, so that Z never underflows. Sweeps run the in-place
+        kernel on Z rescaled by its current estimate, which is refolded into log Z by an exact log-sum-exp sweep
+        whenever the scaled values drift too far from 1.
+
+        :param dtype: Floating point type of the operator and the iterates.
+        :return: log Z of all states and the number of sweeps performed."""
+
+        lmbda = self.lmbda if lmbda is None else lmbda
+        n = self.n_nonterminal_states
+
+        log_G, log_ZT = self._log_desirability_operator(lmbda)
+        data = log_G.data.astype(dtype)
+        indices = log_G.indices
+        starts = log_G.indptr[:-1] # Every nonterminal state has successors
+        rows = np.repeat(np.arange(n), np.diff(log_G.indptr))
+        log_Z = np.concatenate((np.zeros(n), log_ZT)).astype(dtype)
+        x = np.empty(len(data), dtype=dtype)
+        resolution = 8 * np.finfo(dtype).eps * lmbda
+        # Scaled values stay within exp(+-bound), so a single sweep can neither overflow nor underflow them
+        bound = np.exp(np.log(np.finfo(dtype).max) / 3)
+        TY = np.empty(n, dtype=dtype)
+        ratio = np.empty(n, dtype=dtype)
+        n_steps = 0
+
+        with np.errstate(divide='ignore', invalid='ignore', under='ignore'):
+            while True:
+                # Exact log-sum-exp sweep
+                np.take(log_Z, indices, out=x)
+                x += data
+                x_max = np.maximum.reduceat(x, starts)
+                x_max[np.isneginf(x_max)] = 0 # Rows whose successors all have Z = 0 stay at log Z = -inf
+                x -= x_max[rows]
+                np.exp(x, out=x)
+                T = x_max + np.log(np.add.reduceat(x, starts))
+                # States at log Z = -inf give nan differences and are skipped
+                diff = T - log_Z[:n]
+                span = lmbda * (max(np.nanmax(diff), 0) - min(np.nanmin(diff), 0))
+                log_Z[:n] = T
+                n_steps += 1
+                threshold = max(epsilon, resolution * (np.abs(x_max).max() + 1))
+                if span <= threshold:
+                    break
+
+                # Operator rescaled around the new iterate, A_ij = G_ij Z_j / exp(shift_i), over y = Z_N / exp(shift)
+                shift = np.where(np.isfinite(T), T, 0)
+                np.take(log_Z, indices, out=x)
+                x += data
+                x -= shift[rows]
+                np.exp(x, out=x)
+                A = csr_matrix((x, indices, log_G.indptr), shape=log_G.shape)
+                A_N = A[:, :n]
+                b = np.asarray(A[:, n:].sum(axis=1), dtype=dtype).ravel()
+                y = np.exp(T - shift)
+                alive = y > 0
+
+                while span > threshold:
+                    np.copyto(TY, b)
+                    csr_matvec(A_N, y, TY) # TY += A_NN @ y
+                    # Out of range sweeps are discarded and redone in the log domain
+                    if not (TY.max() < bound and np.where(alive, TY, 1).min() > 1 / bound):
+                        break
+                    np.divide(TY, y, out=ratio)
+                    span = lmbda * (max(np.log(np.nanmax(ratio)), 0) - min(np.log(np.nanmin(ratio)), 0))
+                    y, TY = TY, y
+                    n_steps += 1
+
+                log_Z[:n] = shift + np.log(y)
+                if span <= threshold:
+                    break
+
+        return log_Z, n_steps
+
+    def _log_desirability_operator(self, lmbda):
+        """Return the logarithm of the operator G of _desirability_operator, computed without exponentiating the rewards,
+        with the pattern of P0 (log 0 = -inf for explicit zeros), and the terminal log Z values."""
+
+        n = self.n_nonterminal_states
+        log_G = csr_matrix(self.P0, dtype=float, copy=True)
+        with np.errstate(divide='ignore'):
+            log_G.data = np.log(log_G.data) + np.repeat(self.R[:n] / lmbda, np.diff(log_G.indptr))
+        return log_G, self.R[n:] / lmbda
+
+    def power_iteration_by_components(self, G, ZT, lmbda, epsilon = 1e-10):
+        """Power iteration over strongly connected components in reverse topological order (see component_layers).
+
+        :return: The Z function and the total number of layer sweeps performed."""
+
+        n = self.n_nonterminal_states
+        Z = np.concatenate((np.ones(n), ZT))
+        n_steps = 0
+
+        rows = np.repeat(np.arange(n), np.diff(G.indptr))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for states, cyclic in component_layers(rows, G.indices, n):
+                G_layer = G[states]
+                while True:
+                    TZ = G_layer @ Z
+                    # States whose Z underflowed to 0 give 0/0 and are skipped
+                    V_diff = lmbda * np.abs(np.log(TZ / Z[states]))
+                    Z[states] = TZ
+                    n_steps += 1
+                    if not cyclic or not np.nanmax(V_diff, initial=0) > epsilon:
+                        break
+
+        return Z, n_steps
+
+    def power_iteration_anderson(self, G, ZT, lmbda, epsilon = 1e-10, memory = 5):
+        """Power iteration with safeguarded Anderson acceleration (see frameworks.acceleration.anderson) of the
+        desirability operator in the V = lmbda * log(Z) domain, where mixing keeps Z positive.
+
+        :return: The Z function and the number of operator evaluations performed."""
+
+        n = self.n_nonterminal_states
+        G_N = G[:, :n]
+        b = G[:, n:] @ ZT
+        TZ = np.empty(n)
+
+        def soft_bellman(VN):
+            np.copyto(TZ, b)
+            csr_matvec(G_N, np.exp(VN / lmbda), TZ) # TZ += G_NN @ Z
+            with np.errstate(divide='ignore'):
+                return lmbda * np.log(TZ)
+
+        VN, n_steps = anderson(soft_bellman, np.zeros(n), memory, epsilon)
+
+        return np.concatenate((np.exp(soft_bellman(VN) / lmbda), ZT)), n_steps
+
+    def solve(self, method = "power", lmbda = None, epsilon = 1e-10):
+        """Compute the optimal Z function. Apart from power iteration, the first-exit desirability function can be
+        obtained by solving the linear system (I - G_NN) z_N = G_NT z_T over the nonterminal states.
+
+        :param method: 'power' (power iteration), 'direct' (sparse LU factorization) or 'gmres'/'bicgstab' (ILU preconditioned Krylov methods).
+            Krylov solutions that miss the power_iteration criterion on V are replaced by 'direct', with a warning.
+        :return: The Z function and the number of iterations performed (1 for the direct method)."""
+
+        lmbda = self.lmbda if lmbda is None else lmbda
+
+        if method == "power":
+            return self.power_iteration(lmbda, epsilon)
+
+        n = self.n_nonterminal_states
+        G, ZT = self._desirability_operator(lmbda)
+        A = identity(n, format='csr') - G[:, :n]
+        b = G[:, n:] @ ZT
+        ZN, n_steps = solve_sparse(A, b, method, epsilon)
+
+        if method != "direct":
+            # Krylov methods stop on a relative residual, which does not resolve Z values far below max(Z)
+            span = np.inf
+            if (ZN > 0).all():
+                ratio = (G[:, :n] @ ZN + b) / ZN
+                span = lmbda * (np.log(max(ratio.max(), 1)) - np.log(min(ratio.min(), 1)))
+            if not span <= epsilon:
+                warnings.warn(f"{method} solution misses epsilon = {epsilon} in V (span {span:.1e}), solving by 'direct'", RuntimeWarning)
+                ZN, n_steps = solve_sparse(A, b, "direct")
+
+        Z = np.concatenate((ZN, ZT))
+        return Z, n_steps
+
+    def terminal_basis(self, lmbda = None):
+        """Return the (n_nonterminal_states, n_terminal_states) matrix B such that Z_N = B @ Z_T for any terminal
+        desirabilities Z_T = exp(R_T / lmbda), since the first-exit Z function is linear in them. B solves
+        (I - G_NN) B = G_NT with one sparse LU factorization and a single multiple right-hand side solve over the
+        terminal columns.
+
+        The basis of the last lambda is cached until P0, R or lmbda are assigned again. Entries of P0 or R modified in
+        place are not detected."""
+
+        lmbda = self.lmbda if lmbda is None else lmbda
+        n = self.n_nonterminal_states
+
+        if self._terminal_basis is None or self._terminal_basis[0] != lmbda:
+            G, _ = self._desirability_operator(lmbda)
+            A = identity(n, format='csr') - G[:, :n]
+            B, _ = solve_sparse(A, G[:, n:].toarray())
+            self._terminal_basis = (lmbda, B)
+        return self._terminal_basis[1]
+
+    def solve_terminal_rewards(self, terminal_rewards, lmbda = None):
+        """Compute the optimal Z function for the given rewards of the terminal states from the cached terminal basis,
+        e.g. for a new assignment of goal and lava rewards of a minigrid, model.terminal_values(J).
+
+        :param terminal_rewards: (n_terminal_states,) rewards, or a (k, n_terminal_states) batch of them.
+        :return: The (n_states,) Z function, or the (n_states, k) Z functions of a batch."""
+
+        lmbda = self.lmbda if lmbda is None else lmbda
+
+        B = self.terminal_basis(lmbda)
+        ZT = np.exp(np.asarray(terminal_rewards, dtype=float).T / lmbda)
+        return np.concatenate((B @ ZT, ZT))
+
+    def _desirability_operator(self, lmbda):
+        """Return the operator G (nonterminal x all states) such that Z_N = G @ Z, and the fixed terminal Z values."""
+
+        # Fold the reward scaling exp(R_i / lmbda) of every row into the data of a copy of P0
+        G = csr_matrix(self.P0, dtype=float, copy=True)
+        G.data *= np.repeat(np.exp(self.R[:self.n_nonterminal_states] / lmbda), np.diff(G.indptr))
+        ZT = np.exp(self.R[self.n_nonterminal_states:] / lmbda)
+        return G, ZT
     
     
     def compute_Pu(self, Z, sparse = True):
@@ -59,7 +360,7 @@ class LMDP:
 
         else:
             P0 = self.P0.toarray() if isspmatrix_csr(self.P0) else self.P0
-            Pu = self.P0 * Z  # Element-wise multiplication of P0 and Z
+            Pu = P0 * Z  # Element-wise multiplication of P0 and Z
             # Normalize each row of the matrix
             row_sums = Pu.sum(axis=1, keepdims=True)
             Pu /= row_sums
@@ -74,34 +375,15 @@ class LMDP:
         """Embed the LMDP into an MDP."""
 
         lmbda = self.lmbda if lmbda is None else lmbda
-        
-        # Extract the number of actions from nonzero transition probabilities
-        P0 = self.P0.toarray() if isspmatrix_csr(self.P0) else self.P0
-        n_actions = np.max((P0 > 0).sum(axis=1))
-        mdp = MDP(self.n_states, self.n_states - self.n_nonterminal_states, n_actions)
-        Z_opt, _ = self.power_iteration(lmbda)
-        Pu = self.compute_Pu(Z_opt)
-
-        # Compute the reward function
-        row_indices = np.repeat(np.arange(Pu.shape[0]), np.diff(Pu.indptr))
-        log_ratio = np.log(Pu.data / P0[row_indices, Pu.indices])
-        product = Pu.data * log_ratio
-        mdp.R = self.R - lmbda * np.concatenate((np.bincount(row_indices, weights=product), np.zeros(self.n_states-self.n_nonterminal_states)))
-        mdp.R = np.broadcast_to(mdp.R.reshape(-1, 1), (self.n_states, n_actions))
-        
-        # Compute the transition probabilities
-        n_next_states_per_row = np.diff(Pu.indptr)
-        n_next_states = np.unique(n_next_states_per_row)
-
-        # Iterate through all possible transition dimensionalities to avoid heterogeneous matrices
-        for next_states in n_next_states:
-            source_states = np.where(n_next_states_per_row == next_states)[0]
-            source_states_repeated = np.repeat(source_states, next_states)
-            indices = Pu[source_states].indices.reshape(-1, next_states)
-
-            for a in range(mdp.n_actions):
-                rolled_indices = np.roll(indices, -a, axis=1).flatten()
-                mdp.P[source_states_repeated, a, rolled_indices] = Pu[source_states].data
+        n = self.n_nonterminal_states
+
+        mdp, Z_opt, P0, Pu, _, _ = self._embedding_transitions(lmbda)
+
+        # Compute the reward function, the KL divergence of every row of Pu from P0
+        row_indices = np.repeat(np.arange(n), np.diff(P0.indptr))
+        product = xlogy(Pu, Pu / P0.data)
+        mdp.R = self.R - lmbda * np.concatenate((np.bincount(row_indices, weights=product, minlength=n), np.zeros(self.n_states-n)))
+        mdp.R = np.broadcast_to(mdp.R.reshape(-1, 1), (self.n_states, mdp.n_actions))
 
         # Compute the embedding error
         V_lmdp = self.Z_to_V(Z_opt)
@@ -110,7 +392,37 @@ class LMDP:
         embedding_mse = np.mean(np.square(V_lmdp - V_mdp))
 
         return mdp, embedding_mse
-    
+
+    def _embedding_transitions(self, lmbda):
+        """Build the MDP of the embeddings of the LMDP from the CSR arrays of P0.
+
+        :return: The MDP with its transition matrix, the Z function, P0, the data of Pu and the source and target
+            entries of every MDP transition."""
+
+        n = self.n_nonterminal_states
+        P0 = csr_matrix(self.P0, dtype=float, copy=True)
+        P0.eliminate_zeros()
+        next_state_counts = np.diff(P0.indptr)
+        n_actions = next_state_counts.max()
+        mdp = MDP(self.n_states, self.n_states - n, n_actions)
+
+        Z_opt, _ = self.power_iteration(lmbda)
+        row_indices = np.repeat(np.arange(n), next_state_counts)
+        Pu = P0.data * Z_opt[P0.indices]
+        Pu /= np.bincount(row_indices, weights=Pu, minlength=n)[row_indices]
+
+        # Row s * n_actions + a of the MDP holds the support of s, in order, with the probabilities of Pu rolled by a
+        row_counts = np.repeat(next_state_counts, n_actions)
+        indptr = np.concatenate(([0], np.cumsum(row_counts)))
+        rows = np.repeat(np.arange(n * n_actions), row_counts)
+        states, actions = np.divmod(rows, n_actions)
+        positions = np.arange(len(rows)) - indptr[rows]
+        next_state_entries = P0.indptr[states] + positions
+        probability_entries = P0.indptr[states] + (positions - actions) % next_state_counts[states]
+        mdp.P = csr_matrix((Pu[probability_entries], P0.indices[next_state_entries], indptr), shape=mdp.P.shape)
+
+        return mdp, Z_opt, P0, Pu, probability_entries, next_state_entries
+
     def shortest_path_length(self, s=None):
         """Compute the shortest optimal path length from a given state to a terminal state.
         :param s: The starting state. """
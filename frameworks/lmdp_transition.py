@@ -1,88 +1,70 @@
 import numpy as np
-from frameworks.mdp import MDP
 from scipy.sparse import csr_matrix, isspmatrix_csr
+from scipy.special import xlogy
 from frameworks.lmdp import LMDP
 
 
 class LMDP_transition(LMDP):
-    def __init__(self, n_states, n_terminal_states, lmbda = 1, s0 = 0):
+    def __init__(self, n_states, n_terminal_states, lmbda = 1, s0 = 0, seed = None):
         self.n_states = n_states
         self.n_nonterminal_states = n_states - n_terminal_states
-        self.P0 = np.zeros((self.n_nonterminal_states, n_states))
-        self.R = np.zeros((self.n_nonterminal_states, n_states))
+        self.P0 = csr_matrix((self.n_nonterminal_states, n_states))
+        self.R = csr_matrix((self.n_nonterminal_states, n_states))
         self.J = np.zeros(n_terminal_states)
         self.s0 = s0
         self.lmbda = lmbda
+        self.rng = np.random.default_rng(seed)
+        self._samplers = {}
+        self._terminal_basis = None
         
 
     def act(self, current_state, P):
         """Transition function."""
 
-        # Check if the transition matrix is sparse 
-        if isspmatrix_csr(P):
-            next_state = np.random.choice(P[current_state].indices, p=P[current_state].data) # Using sparse matrix
-        else:
-            next_state = np.random.choice(self.n_states, p=P[current_state])
+        next_state = self.sampler(P).sample(current_state)
         reward = self.R[current_state, next_state]
         terminal = next_state >= self.n_nonterminal_states
         return next_state, reward, terminal
     
-    def power_iteration(self, lmbda = None, epsilon = 1e-10):
-        """Power iteration algorithm to compute the optimal Z function."""
-
-        lmbda = self.lmbda if lmbda is None else lmbda
+    def _desirability_operator(self, lmbda):
+        """Return the operator G (nonterminal x all states) such that Z_N = G @ Z, and the fixed terminal Z values."""
 
         P0 = self.P0 if isspmatrix_csr(self.P0) else csr_matrix(self.P0)
         R = self.R if isspmatrix_csr(self.R) else csr_matrix(self.R)
-        
-        Z = np.ones(self.n_states)
-        V_diff = np.arange(self.n_states)
-        n_steps = 0
-        
+
         O = csr_matrix((np.exp(R.data/lmbda), R.indices, R.indptr), shape=R.shape)
-        G = P0.multiply(O)
+        G = csr_matrix(P0.multiply(O))
         ZT = np.exp(self.J / lmbda)
+        return G, ZT
 
-        while max(V_diff) - min(V_diff) > epsilon:
-            TZ = G @ Z
-            TZ = np.concatenate((TZ, ZT))
-            V_diff = self.Z_to_V(TZ) - self.Z_to_V(Z)
-            Z = TZ
-            n_steps += 1
+    def _log_desirability_operator(self, lmbda):
+        """Return the logarithm of the operator G of _desirability_operator, over its pattern (the transitions of P0 with
+        a stored reward), computed without exponentiating the rewards, and the terminal log Z values."""
 
-        return Z, n_steps
+        P0 = self.P0 if isspmatrix_csr(self.P0) else csr_matrix(self.P0)
+        R = self.R if isspmatrix_csr(self.R) else csr_matrix(self.R)
+
+        log_G = csr_matrix(P0.multiply(csr_matrix((np.ones(R.nnz), R.indices, R.indptr), shape=R.shape)))
+        rows = np.repeat(np.arange(log_G.shape[0]), np.diff(log_G.indptr))
+        log_G.data = np.log(log_G.data) + np.asarray(R[rows, log_G.indices]).ravel() / lmbda
+        return log_G, self.J / lmbda
     
     
     def embedding_to_MDP(self, lmbda = None):
         """Embed the LMDP into an MDP."""
 
         lmbda = self.lmbda if lmbda is None else lmbda
-        
-        # Extract the number of actions from nonzero transition probabilities
-        P0 = self.P0.toarray() if isspmatrix_csr(self.P0) else self.P0
-        #R = self.R.toarray() if isspmatrix_csr(self.R) else self.R
-        n_actions = np.max((P0 > 0).sum(axis=1))
-        mdp = MDP(self.n_states, self.n_states - self.n_nonterminal_states, n_actions)
-        Z_opt, _ = self.power_iteration(lmbda)
-        Pu = self.compute_Pu(Z_opt)
-
-        # Compute the transition probabilities
-        n_next_states_per_row = np.diff(Pu.indptr)
-        n_next_states = np.unique(n_next_states_per_row)
-
-        # Iterate through all possible transition dimensionalities to avoid heterogeneous matrices
-        for next_states in n_next_states:
-            source_states = np.where(n_next_states_per_row == next_states)[0]
-            source_states_repeated = np.repeat(source_states, next_states)
-            indices = Pu[source_states].indices.reshape(-1, next_states)
+        n = self.n_nonterminal_states
 
-            for a in range(mdp.n_actions):
-                rolled_indices = np.roll(indices, -a, axis=1).flatten()
-                mdp.P[source_states_repeated, a, rolled_indices] = Pu[source_states].data
+        mdp, Z_opt, P0, Pu, probability_entries, next_state_entries = self._embedding_transitions(lmbda)
 
-        for state in range(self.n_nonterminal_states):
-            for a in range(mdp.n_actions):
-                mdp.R[state,a] = self.R[state, Pu[state].indices].dot(mdp.P[state, a, Pu[state].indices]) - lmbda * np.dot(mdp.P[state, a, Pu[state].indices], np.log(mdp.P[state, a, Pu[state].indices] / P0[state, Pu[state].indices]))
+        # Expected reward of every action, R(s, s') - lmbda * log(P(s'|s, a) / P0(s'|s)) over its next states s'
+        R = csr_matrix(self.R)
+        R_entries = np.asarray(R[np.repeat(np.arange(n), np.diff(P0.indptr)), P0.indices]).ravel()
+        P_sa = Pu[probability_entries]
+        rewards = P_sa * R_entries[next_state_entries] - lmbda * xlogy(P_sa, P_sa / P0.data[next_state_entries])
+        rows = np.repeat(np.arange(n * mdp.n_actions), np.diff(mdp.P.indptr))
+        mdp.R[:n] = np.bincount(rows, weights=rewards, minlength=n * mdp.n_actions).reshape(n, mdp.n_actions)
 
         # Compute the embedding error
         V_lmdp = self.Z_to_V(Z_opt)
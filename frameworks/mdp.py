@@ -1,29 +1,91 @@
+import heapq
 import numpy as np
 import frameworks
-from scipy.sparse import csr_matrix
+from scipy.sparse import csr_matrix, isspmatrix_csr, identity
+from scipy.sparse.csgraph import dijkstra
+from scipy.sparse.linalg import splu
+from scipy.optimize import minimize_scalar, brentq
+from frameworks.sampling import TransitionSampler
+from frameworks.decomposition import component_layers
+from frameworks.linalg import solve_sparse, lstsq_batch
+from frameworks.acceleration import anderson
 
 class MDP:
-    def __init__(self, n_states, n_terminal_states, n_actions, gamma = 1, s0 = 0):
+    def __init__(self, n_states, n_terminal_states, n_actions, gamma = 1, s0 = 0, seed = None):
         self.n_states = n_states
         self.n_nonterminal_states = n_states - n_terminal_states
         self.n_actions = n_actions
-        self.P = np.zeros((self.n_nonterminal_states, n_actions, n_states))
+        self.P = csr_matrix((self.n_nonterminal_states * n_actions, n_states)) # Row s * n_actions + a holds the next state distribution of (s, a)
         self.R = np.zeros((n_states, n_actions)) # Assuming terminal states are at the end of the state space
         self.s0 = s0
         self.gamma = gamma
+        self.rng = np.random.default_rng(seed)
+
+    @property
+    def P(self):
+        return self._P
+
+    @P.setter
+    def P(self, P):
+        # Any cached structure derived from the transition matrix becomes stale
+        self._P = P
+        self._next_states = None
+        self._is_deterministic = None
+        self._sampler = None
+
+    def set_next_states(self, next_states):
+        """Set deterministic dynamics from an integer (n_nonterminal_states, n_actions) next state table."""
+
+        next_states = np.asarray(next_states, dtype=int).reshape(self.n_nonterminal_states, self.n_actions)
+        self.P = csr_matrix((np.ones(next_states.size), next_states.flatten(), np.arange(next_states.size + 1)), shape=(next_states.size, self.n_states))
+        self._next_states = next_states
+        self._is_deterministic = True
+
+    def next_state_table(self):
+        """Return the integer (n_nonterminal_states, n_actions) next state table if the dynamics are deterministic, None otherwise."""
+
+        if self._is_deterministic is None:
+            P = self.transition_matrix()
+            self._is_deterministic = bool((np.diff(P.indptr) == 1).all() and (P.data != 0).all())
+            self._next_states = P.indices.reshape(self.n_nonterminal_states, self.n_actions) if self._is_deterministic else None
+        return self._next_states
 
     def act(self, current_state, action):
         """Transition function."""
-        
-        next_state = np.random.choice(self.n_states, p=self.P[current_state, action]) 
+
+        next_states = self.next_state_table()
+        if next_states is not None:
+            next_state = next_states[current_state, action] # Deterministic dynamics
+        else:
+            next_state = self.sampler().sample(current_state * self.n_actions + action)
         reward = self.R[current_state, action]
         terminal = next_state >= self.n_nonterminal_states
         return next_state, reward, terminal
     
-    def value_iteration(self, epsilon=1e-10, gamma = None):
-        """Value iteration algorithm."""
+    def act_batch(self, current_states, actions):
+        """Vectorized transition function for arrays of states and actions."""
+
+        next_states = self.next_state_table()
+        if next_states is not None:
+            next_states = next_states[current_states, actions]
+        else:
+            next_states = self.sampler().sample_batch(current_states * self.n_actions + actions)
+        rewards = self.R[current_states, actions]
+        terminal = next_states >= self.n_nonterminal_states
+        return next_states, rewards, terminal
+
+    def value_iteration(self, epsilon=1e-10, gamma = None, decompose = False, accelerate = False):
+        """Value iteration algorithm.
+
+        :param decompose: Solve the strongly connected components of the transition graph one layer at a time, from the
+            ones closest to the terminal states, iterating only within each layer (see value_iteration_by_components).
+        :param accelerate: Apply safeguarded Anderson acceleration to the Bellman operator (see value_iteration_anderson)."""
 
         gamma = self.gamma if gamma is None else gamma
+        if decompose:
+            return self.value_iteration_by_components(epsilon, gamma)
+        if accelerate:
+            return self.value_iteration_anderson(epsilon, gamma)
 
         #Q = np.concatenate((np.zeros((self.n_nonterminal_states, self.n_actions)), self.R[self.n_nonterminal_states:]), axis=0)
         Q = np.zeros((self.n_states, self.n_actions))
@@ -31,11 +93,15 @@ class MDP:
         n_steps = 0
 
         R = self.R[:self.n_nonterminal_states]
-        P = gamma * self.P
+        next_states = self.next_state_table()
+        P = gamma * self.transition_matrix() if next_states is None else None
         QT = self.R[self.n_nonterminal_states:]
 
-        while max(V_diff) - min(V_diff) > epsilon:
-            TQ = R + P @ Q.max(axis=1)
+        while V_diff.max() - V_diff.min() > epsilon:
+            if next_states is not None:
+                TQ = R + gamma * Q.max(axis=1)[next_states] # Deterministic backup as a gather
+            else:
+                TQ = R + (P @ Q.max(axis=1)).reshape(self.n_nonterminal_states, self.n_actions)
             TQ = np.concatenate((TQ, QT))
             V_diff = TQ.max(axis=1) - Q.max(axis=1)
             Q = TQ
@@ -44,24 +110,392 @@ class MDP:
         policy = np.argmax(Q, axis=1)
 
         return Q, policy, n_steps
-    
+
+    def value_iteration_anderson(self, epsilon=1e-10, gamma = None, memory = 5):
+        """Value iteration with safeguarded Anderson acceleration of the Bellman operator over the nonterminal values
+        (see frameworks.acceleration.anderson), stopping on the same criterion as value_iteration.
+
+        :return: The Q function, the greedy policy and the number of Bellman backups performed."""
+
+        gamma = self.gamma if gamma is None else gamma
+        n, A = self.n_nonterminal_states, self.n_actions
+
+        P = gamma * self.transition_matrix()
+        R = self.R[:n]
+        V = np.concatenate((np.zeros(n), self.R[n:].max(axis=1)))
+
+        def bellman(VN):
+            V[:n] = VN
+            return (R + (P @ V).reshape(n, A)).max(axis=1)
+
+        V[:n], n_steps = anderson(bellman, np.zeros(n), memory, epsilon)
+        Q = self._q_function(V, gamma)
+        policy = np.argmax(Q, axis=1)
+
+        return Q, policy, n_steps
+
+    def value_iteration_batch(self, gammas = None, rewards = None, epsilon=1e-10):
+        """Value iteration for several configurations of gamma and reward function at once, sharing the dynamics.
+
+        :param gammas: Discount factor or vector of k discount factors (default self.gamma).
+        :param rewards: (n_states, n_actions) reward table or (k, n_states, n_actions) stack of them (default self.R).
+        :return: The (k, n_states, n_actions) Q functions, the (k, n_states) greedy policies and the number of
+            iterations of every configuration."""
+
+        n, A = self.n_nonterminal_states, self.n_actions
+        gammas = np.atleast_1d(self.gamma if gammas is None else gammas).astype(float)
+        rewards = np.asarray(self.R if rewards is None else rewards, dtype=float)
+        rewards = rewards[np.newaxis] if rewards.ndim == 2 else rewards
+        k = max(len(gammas), len(rewards))
+        assert len(gammas) in (1, k) and len(rewards) in (1, k), "gammas and rewards must have the same number of configurations"
+        gammas = np.broadcast_to(gammas, (k,))
+        rewards = np.broadcast_to(rewards, (k, self.n_states, A))
+
+        Q = np.zeros((k, self.n_states, A))
+        Q[:, n:] = rewards[:, n:]
+        V = np.zeros((k, self.n_states))
+        n_steps = np.zeros(k, dtype=int)
+        active = np.arange(k)
+
+        next_states = self.next_state_table()
+        P = self.transition_matrix() if next_states is None else None
+
+        while len(active):
+            V_active = V[active]
+            if next_states is not None:
+                PV = V_active[:, next_states] # Deterministic backup as a gather
+            else:
+                PV = (P @ V_active.T).reshape(n, A, len(active)).transpose(2, 0, 1)
+            Q[active, :n] = rewards[active, :n] + gammas[active, np.newaxis, np.newaxis] * PV
+            TV = Q[active].max(axis=2)
+            V_diff = TV - V_active
+            V[active] = TV
+            n_steps[active] += 1
+            active = active[V_diff.max(axis=1) - V_diff.min(axis=1) > epsilon]
+
+        policy = np.argmax(Q, axis=2)
+
+        return Q, policy, n_steps
+
+    def policy_iteration(self, gamma = None, method = "direct", epsilon = 1e-10):
+        """Policy iteration algorithm, starting from a proper policy (see proper_policy).
+
+        :param method: Linear solver of the evaluation step, 'direct', 'gmres' or 'bicgstab' (see frameworks.linalg.solve_sparse).
+        :return: The Q function, the greedy policy and the number of policy iterations performed."""
+
+        gamma = self.gamma if gamma is None else gamma
+        n = self.n_nonterminal_states
+
+        policy = self.proper_policy()
+        n_steps = 0
+        while True:
+            V = self.evaluate_policy(policy, gamma, method, epsilon)
+            Q = self._q_function(V, gamma)
+            n_steps += 1
+            greedy = np.argmax(Q[:n], axis=1)
+            # Differences below the accuracy of the evaluation are ties, otherwise rounding can make the policy cycle
+            tol = epsilon * max(1, np.abs(V).max())
+            improved = Q[np.arange(n), greedy] > Q[np.arange(n), policy] + tol
+            if not improved.any():
+                break
+            policy = np.where(improved, greedy, policy)
+
+        policy = np.argmax(Q, axis=1)
+
+        return Q, policy, n_steps
+
+    def modified_policy_iteration(self, k = 10, gamma = None, epsilon = 1e-10):
+        """Modified policy iteration algorithm.
+
+        :param k: Number of evaluation sweeps after every greedy improvement.
+        :return: The Q function, the greedy policy and the number of improvement steps performed."""
+
+        gamma = self.gamma if gamma is None else gamma
+        n, A = self.n_nonterminal_states, self.n_actions
+
+        P = self.transition_matrix()
+        R = self.R[:n]
+        V = self.evaluate_policy(self.proper_policy(), gamma)
+        n_steps = 0
+
+        while True:
+            Q = self._q_function(V, gamma)
+            V_diff = Q.max(axis=1) - V
+            n_steps += 1
+            if V_diff.max() - V_diff.min() <= epsilon:
+                break
+
+            policy = np.argmax(Q[:n], axis=1)
+            rows = np.arange(n) * A + policy
+            P_pi = gamma * P[rows]
+            R_pi = R[np.arange(n), policy]
+            V[:n] = Q[np.arange(n), policy]
+            for _ in range(k):
+                V[:n] = R_pi + P_pi @ V
+
+        policy = np.argmax(Q, axis=1)
+
+        return Q, policy, n_steps
+
+    def evaluate_policy(self, policy, gamma = None, method = "direct", epsilon = 1e-10):
+        """Value function of a deterministic policy over the nonterminal states, solving the sparse linear system
+        (I - gamma P_pi,NN) V_N = R_pi + gamma P_pi,NT V_T. The terminal values are their (action independent) rewards."""
+
+        gamma = self.gamma if gamma is None else gamma
+        n, A = self.n_nonterminal_states, self.n_actions
+
+        P_pi = self.transition_matrix()[np.arange(n) * A + policy[:n]]
+        R_pi = self.R[np.arange(n), policy[:n]]
+        VT = self.R[n:].max(axis=1)
+
+        M = identity(n, format='csr') - gamma * P_pi[:, :n]
+        b = R_pi + gamma * (P_pi[:, n:] @ VT)
+        VN, _ = solve_sparse(M, b, method, epsilon)
+        return np.concatenate((VN, VT))
+
+    def proper_policy(self):
+        """Policy that moves every state closer to the terminal states: the chosen action has a positive probability
+        of reaching a state fewer transitions away from them, so every state that can terminate does so with probability 1."""
+
+        n, A = self.n_nonterminal_states, self.n_actions
+
+        P = self.transition_matrix()
+        rows = np.repeat(np.arange(P.shape[0]), np.diff(P.indptr))
+        reverse = csr_matrix((np.ones(P.nnz), (P.indices, rows // A)), shape=(self.n_states, self.n_states))
+        distances = dijkstra(reverse, indices=np.arange(n, self.n_states), unweighted=True, min_only=True)
+
+        # Distance of the closest successor of every (s, a) pair
+        closest = np.full(P.shape[0], np.inf)
+        np.minimum.at(closest, rows, distances[P.indices])
+        return np.argmin(closest.reshape(n, A), axis=1)
+
+    def _q_function(self, V, gamma):
+        """Q function of a value function, with the terminal rewards as terminal rows."""
+
+        n, A = self.n_nonterminal_states, self.n_actions
+        Q = self.R[:n] + gamma * (self.transition_matrix() @ V).reshape(n, A)
+        return np.concatenate((Q, self.R[n:]))
+
+    def value_iteration_by_components(self, epsilon=1e-10, gamma = None):
+        """Value iteration over strongly connected components in reverse topological order (see component_layers).
+
+        :return: The Q function, the greedy policy and the total number of layer sweeps performed."""
+
+        gamma = self.gamma if gamma is None else gamma
+        n, A = self.n_nonterminal_states, self.n_actions
+
+        P = self.transition_matrix()
+        Q = np.concatenate((np.zeros((n, A)), self.R[n:]), axis=0)
+        V = Q.max(axis=1)
+        n_steps = 0
+
+        rows = np.repeat(np.arange(P.shape[0]) // A, np.diff(P.indptr))
+        for states, cyclic in component_layers(rows, P.indices, n):
+            P_layer = gamma * P[(states[:, np.newaxis] * A + np.arange(A)).ravel()]
+            R_layer = self.R[states]
+            while True:
+                TQ = R_layer + (P_layer @ V).reshape(len(states), A)
+                V_diff = TQ.max(axis=1) - V[states]
+                Q[states] = TQ
+                V[states] = TQ.max(axis=1)
+                n_steps += 1
+                if not cyclic or np.abs(V_diff).max() <= epsilon:
+                    break
+
+        policy = np.argmax(Q, axis=1)
+
+        return Q, policy, n_steps
+
+    def prioritized_sweeping(self, epsilon=1e-10, gamma = None):
+        """Value iteration with in-place backups of one state at a time, in decreasing order of Bellman residual.
+
+        :return: The Q function, the greedy policy and the number of single state backups performed."""
+
+        gamma = self.gamma if gamma is None else gamma
+        n, A = self.n_nonterminal_states, self.n_actions
+
+        P = self.transition_matrix()
+        R = self.R[:n]
+        Q = np.concatenate((np.full((n, A), -np.inf), self.R[n:]), axis=0)
+        V = Q.max(axis=1)
+
+        # Predecessor index: row s' of PT holds the (s, a) pairs that reach s' and their probabilities
+        PT = P.T.tocsr()
+        predecessors = PT.indices // A
+        weights = gamma * PT.data
+        priority = np.zeros(self.n_states)
+        n_backups = 0
+
+        while True:
+            # Initial residuals from one synchronous backup, unchanged -inf values having no residual
+            TQ = R + gamma * (P @ V).reshape(n, A)
+            with np.errstate(invalid='ignore'):
+                priority[:n] = np.nan_to_num(np.abs(TQ.max(axis=1) - V[:n]), nan=0)
+            n_backups += n
+
+            queue = [(-p, s) for s, p in enumerate(priority[:n]) if p > epsilon]
+            heapq.heapify(queue)
+
+            while queue:
+                _, s = heapq.heappop(queue)
+                if priority[s] <= epsilon:
+                    continue # Stale entry of a state backed up since it was pushed
+
+                start, end = P.indptr[s * A], P.indptr[(s + 1) * A]
+                actions = np.repeat(np.arange(A), np.diff(P.indptr[s * A:(s + 1) * A + 1]))
+                Q[s] = R[s] + gamma * np.bincount(actions, P.data[start:end] * V[P.indices[start:end]], minlength=A)
+                delta = abs(Q[s].max() - V[s]) if Q[s].max() != V[s] else 0
+                V[s] = Q[s].max()
+                priority[s] = 0
+                n_backups += 1
+
+                start, end = PT.indptr[s], PT.indptr[s + 1]
+                preds = predecessors[start:end]
+                np.add.at(priority, preds, weights[start:end] * delta)
+                for p in preds[priority[preds] > epsilon]:
+                    heapq.heappush(queue, (-priority[p], p))
+
+            # States that cannot reach a terminal state are still at -inf, restart them from 0 as value_iteration does
+            unreached = np.isneginf(V[:n])
+            if not unreached.any():
+                break
+            Q[:n][unreached] = 0
+            V[:n][unreached] = 0
+
+        policy = np.argmax(Q, axis=1)
+
+        return Q, policy, n_backups
+
+    def sampler(self):
+        """Return the next state sampler of the transition matrix, built once per matrix."""
+
+        if self._sampler is None:
+            self._sampler = TransitionSampler(self.transition_matrix(), self.rng)
+        return self._sampler
+
+    def transition_matrix(self):
+        """Return the transition probabilities as a stacked (n_nonterminal_states * n_actions, n_states) CSR matrix.
+        Dense (n_nonterminal_states, n_actions, n_states) tensors are converted on the fly."""
+
+        return self.P if isspmatrix_csr(self.P) else csr_matrix(np.reshape(self.P, (-1, self.n_states)))
+
+    def label_setting(self):
+        """Optimal Q function of a deterministic MDP with nonpositive nonterminal rewards and gamma = 1 in O(S log S).
+
+        :return: The Q function, the greedy policy and the number of steps performed (1)."""
+
+        next_states = self.next_state_table()
+        assert next_states is not None, "Label setting requires deterministic dynamics"
+        n, A = self.n_nonterminal_states, self.n_actions
+        R = self.R[:n]
+        assert (R <= 0).all(), "Label setting requires nonpositive nonterminal rewards"
+        VT = self.R[n:].max(axis=1)
+
+        # Reverse graph with an extra source node linked to every terminal state, offset so that all costs are nonnegative
+        source = self.n_states
+        offset = VT.max() if len(VT) else 0
+        heads = np.concatenate((next_states.ravel(), np.full(len(VT), source)))
+        tails = np.concatenate((np.repeat(np.arange(n), A), np.arange(n, self.n_states)))
+        costs = np.concatenate((-R.ravel(), offset - VT))
+
+        # Keep only the cheapest of parallel edges, which the sparse constructor would otherwise sum up
+        order = np.lexsort((costs, tails, heads))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = (heads[order][1:] != heads[order][:-1]) | (tails[order][1:] != tails[order][:-1])
+        order = order[first]
+        graph = csr_matrix((costs[order], (tails[order], heads[order])), shape=(self.n_states + 1, self.n_states + 1))
+
+        V = offset - dijkstra(graph.T.tocsr(), indices=source)[:self.n_states]
+        V[n:] = VT
+        Q = np.concatenate((R + V[next_states], self.R[n:]))
+        policy = np.argmax(Q, axis=1)
+
+        return Q, policy, 1
+
     def shortest_path_length(self, s = None):
         """Compute the shortest optimal path length from a given state to a terminal state.
+        Deterministic MDPs follow the greedy policy through the next state table, using the label setting solver when
+        gamma = 1 and nonterminal rewards are nonpositive.
         :param s: The starting state. """
 
         s = self.s0 if s is None else s
 
-        _, policy, _ = self.value_iteration()
+        next_states = self.next_state_table()
+        if next_states is not None and self.gamma == 1 and (self.R[:self.n_nonterminal_states] <= 0).all():
+            _, policy, _ = self.label_setting()
+        else:
+            _, policy, _ = self.value_iteration()
 
-        done = s >= self.n_nonterminal_states
         n_steps = 0
+        if next_states is not None:
+            while s < self.n_nonterminal_states:
+                s = next_states[s, policy[s]]
+                n_steps += 1
+            return n_steps
+
+        done = s >= self.n_nonterminal_states
         while not done:
             s, _, done = self.act(s, policy[s])
             n_steps += 1
         return n_steps
 
-    def embedding_to_LMDP(self, lmbda = 1, gamma = 1):
-        """Embed the MDP into an LMDP."""
+    def _embedding_reward_scale(self, lmdp, R, V, lmbda, tol = 1e-5, method = "direct"):
+        """Find the scaling K in [0, 1] of the rewards R of the LMDP that minimizes the mean squared error between its
+        value function and V.
+
+        :param tol: Tolerance on K.
+        :param method: 'direct' (a root of the error derivative over sparse LU solves) or 'power' (bounded minimization
+            over warm-started power iteration solves).
+        :return: The scaling K and the Z function of the LMDP with rewards K * R."""
+
+        n = self.n_nonterminal_states
+        lmdp.R = R
+        G, _ = lmdp._desirability_operator(lmbda)
+        P0_data = csr_matrix(lmdp.P0, dtype=float).data
+        row_rewards = np.repeat(R[:n], np.diff(G.indptr))
+        solutions = {}
+
+        def solve(K):
+            G.data = P0_data * np.exp(K * row_rewards / lmbda)
+            ZT = np.exp(K * R[n:] / lmbda)
+            if method == "direct":
+                G_N, G_T = G[:, :n], G[:, n:]
+                lu = splu((identity(n, format='csr') - G_N).tocsc())
+                ZN = lu.solve(G_T @ ZT)
+                dZN = lu.solve(R[:n] / lmbda * ZN + G_T @ (R[n:] / lmbda * ZT))
+                solutions[K] = np.concatenate((ZN, ZT)), np.concatenate((dZN, R[n:] / lmbda * ZT))
+            else:
+                K_prev = next(reversed(solutions), 0)
+                Z0 = solutions[K_prev] ** (K / K_prev) if K_prev > 0 else None
+                solutions[K] = lmdp.power_iteration_sweeps(G, ZT, lmbda, Z0=Z0)[0]
+            return solutions[K]
+
+        with np.errstate(divide='ignore'):
+            if method == "direct":
+                def gradient(K):
+                    Z, dZ = solve(K)
+                    return np.mean(2 * (lmdp.Z_to_V(Z, lmbda) - V) * lmbda * dZ / Z)
+
+                # The error is unimodal in K, so its minimum is at a bound unless the derivative changes sign
+                K_min, K_max = tol, 1
+                if gradient(K_min) >= 0:
+                    K = K_min
+                elif gradient(K_max) <= 0:
+                    K = K_max
+                else:
+                    K = brentq(gradient, K_min, K_max, xtol=tol)
+                return K, solutions[K][0]
+
+            assert method == "power", f"Invalid method {method}"
+            K = minimize_scalar(lambda K: np.mean(np.square(lmdp.Z_to_V(solve(K), lmbda) - V)), bounds=(0, 1), method='bounded', options={'xatol': tol}).x
+            return K, solutions[K]
+
+    def embedding_to_LMDP(self, lmbda = 1, gamma = 1, tol = 1e-5, method = "direct"):
+        """Embed the MDP into an LMDP.
+
+        :param tol: Tolerance on the scaling of the rewards of the deterministic embedding.
+        :param method: Solver of the search over the scaling of the rewards of the deterministic embedding, 'direct'
+            or 'power' (see _embedding_reward_scale)."""
 
         # Compute the value function of the original MDP without discounting
         Q, _, _ = self.value_iteration(gamma=gamma)
@@ -69,84 +503,78 @@ class MDP:
 
         # Create the LMDP
         lmdp = frameworks.lmdp.LMDP(self.n_states, self.n_states - self.n_nonterminal_states)
+        P = self.transition_matrix()
         # Check if all actions from all states are deterministic. Otherwise, the stochastic LMDP embedding will perform better
-        is_deterministic = (np.count_nonzero(self.P, axis=2) == np.ones((self.n_nonterminal_states, self.n_actions))).all()
+        is_deterministic = self.next_state_table() is not None
+        Z0 = None
+
+        # Sparse operator that sums the rows of all actions of each state
+        action_sum = csr_matrix((np.ones(P.shape[0]), (np.repeat(np.arange(self.n_nonterminal_states), self.n_actions), np.arange(P.shape[0]))), shape=(self.n_nonterminal_states, P.shape[0]))
 
         # Apply the deterministic LMDP embedding
         if is_deterministic:
 
             lmdp.R = np.sum(self.R, axis = 1)/self.n_actions
-            lmdp.P0 = np.sum(self.P, axis = 1)/self.n_actions
+            lmdp.P0 = (action_sum @ P)/self.n_actions
 
             # Update reward function with KL divergence (SPA embedding)
             Z, _ = lmdp.power_iteration(lmbda)
             Pu = lmdp.compute_Pu(Z, sparse=True)
             row_indices = np.repeat(np.arange(Pu.shape[0]), np.diff(Pu.indptr))
-            log_ratio = np.log(Pu.data / lmdp.P0[row_indices, Pu.indices])
+            log_ratio = np.log(Pu.data / np.asarray(lmdp.P0[row_indices, Pu.indices]).ravel())
             product = Pu.data * log_ratio
             R = np.sum(self.R, axis = 1)/self.n_actions + lmbda * np.concatenate((np.bincount(row_indices, weights=product), np.zeros(self.n_states-self.n_nonterminal_states)))
 
-            K_min = 0
-            K_max = 1
-
-            #Find the optimal K through ternary search
-            while K_max - K_min > 1e-5:
-                m1 = K_min + (K_max - K_min) / 3
-                lmdp.R = m1 * R
-                #lmdp.R[self.n_nonterminal_states:] = R[self.n_nonterminal_states:]
-                Z1, _ = lmdp.power_iteration(lmbda)
-                mse1 = np.mean(np.square(lmdp.Z_to_V(Z1) - V))
-                
-                m2 = K_max - (K_max - K_min) / 3
-                lmdp.R = m2 * R
-                #lmdp.R[self.n_nonterminal_states:] = R[self.n_nonterminal_states:]
-                Z2, _ = lmdp.power_iteration(lmbda)
-                mse2 = np.mean(np.square(lmdp.Z_to_V(Z2) - V))
-                if mse1 > mse2:
-                    K_min = m1
-                else:
-                    K_max = m2
-
-            lmdp.R = K_min * R
+            K, Z0 = self._embedding_reward_scale(lmdp, R, V, lmbda, tol, method)
+            lmdp.R = K * R
             #lmdp.R[self.n_nonterminal_states:] = R[self.n_nonterminal_states:]
 
         # Apply the non-deterministic LMDP embedding (from Todorov et al. 2009)
         else:
             epsilon = 1e-10
-            D = self.P
-            # Find columns that contain any non-zero values
-            cols_with_nonzero = np.any(D != 0, axis=1)
-            unique_next_state_counts = np.unique(np.sum(cols_with_nonzero, axis=1))
+            A = self.n_actions
+            # Find the next states reachable from each state under any action
+            support = action_sum @ P
+            support.eliminate_zeros()
+            support.sort_indices()
+            next_state_counts = np.diff(support.indptr)
 
-            # Perform the vectorized embedding for each unique number of next states
-            for next_state_count in unique_next_state_counts:
+            # Scatter P into one (n_actions, next_state_count) block per state, over the columns of the support of the
+            # state, locating every transition in the support by its (state, next state) key
+            rows = np.repeat(np.arange(P.shape[0]), np.diff(P.indptr))
+            nonzero = P.data != 0
+            states, cols = rows[nonzero] // A, P.indices[nonzero]
+            support_keys = np.repeat(np.arange(self.n_nonterminal_states), next_state_counts) * self.n_states + support.indices
+            positions = np.searchsorted(support_keys, states * self.n_states + cols) - support.indptr[states]
+            block_offsets = A * support.indptr[:-1]
+            D_blocks = np.bincount(block_offsets[states] + rows[nonzero] % A * next_state_counts[states] + positions, weights=P.data[nonzero], minlength=A * support.nnz)
+            P0_data = np.empty(support.nnz)
 
-                source_states = np.where(np.sum(cols_with_nonzero, axis=1) == next_state_count)[0]
-                source_states_repeated = np.repeat(source_states, next_state_count)
-                next_states = np.where(cols_with_nonzero[source_states])[1]
+            # Perform the vectorized embedding for each unique number of next states
+            for next_state_count in np.unique(next_state_counts):
 
-                # Remove the columns that contain only zeros and keep only possible transitions
-                D_count = np.array([D[i][:, cols_with_nonzero[i]] for i in source_states])
+                source_states = np.where(next_state_counts == next_state_count)[0]
+                D_count = D_blocks[block_offsets[source_states][:, np.newaxis] + np.arange(A * next_state_count)].reshape(-1, A, next_state_count)
 
                 # Substitute 0s in actual possible transitions columns with 'epsilon' and renormalize
                 D_count[D_count == 0] = epsilon
                 D_count /= D_count.sum(axis=2, keepdims=True)
 
-                # Apply the Pseudo-Inverse method to both square and non-square matrices
+                # Solve the square and non-square systems D C = B in the least squares sense
                 B = self.R[source_states] + np.sum(D_count * np.log(D_count), axis = 2)
-                pseudo_inverse_D = np.linalg.pinv(D_count)
-                C = np.einsum('ijk,ik->ij', pseudo_inverse_D, B)
+                C = lstsq_batch(D_count, B)
 
                 R = np.log(np.sum(np.exp(-C), axis=1))
                 M = - R[:, np.newaxis] + C
 
                 # Assign the reward and initial state distribution to the LMDP in the corresponding states
                 lmdp.R[source_states] = R
-                lmdp.P0[source_states_repeated, next_states] = np.exp(M).flatten()
+                P0_data[support.indptr[source_states][:, np.newaxis] + np.arange(next_state_count)] = np.exp(M)
 
+            lmdp.P0 = csr_matrix((P0_data, support.indices, support.indptr), shape=(self.n_nonterminal_states, self.n_states))
             lmdp.R[self.n_nonterminal_states:] = np.sum(self.R[self.n_nonterminal_states:], axis = 1)/self.n_actions
 
         
-        embedding_mse = np.mean(np.square(lmdp.Z_to_V(lmdp.power_iteration(lmbda)[0]) - V))
-        lmdp.P0 = csr_matrix(lmdp.P0)
+        # The deterministic embedding warm starts from the solution found by the search
+        embedding_mse = np.mean(np.square(lmdp.Z_to_V(lmdp.power_iteration(lmbda, Z0=Z0)[0]) - V))
         return lmdp, embedding_mse
@@ -0,0 +1,80 @@
+import numpy as np
+from scipy.sparse import csr_matrix
+
+
+def row_positions(indptr, rows):
+    """Return the positions in the data array of all the nonzeros of the given CSR rows, with the number of nonzeros
+    of each row and the offset of each row inside the returned positions."""
+
+    starts = indptr[rows]
+    lengths = indptr[rows + 1] - starts
+    offsets = np.cumsum(lengths) - lengths
+    positions = np.repeat(starts - offsets, lengths) + np.arange(lengths.sum())
+    return positions, lengths, offsets
+
+
+class TransitionSampler:
+    """
+    Samples next states from the rows of a transition matrix.
+
+    Every row keeps the cumulative distribution of its nonzero entries, built once per matrix, so a draw is a search
+    over the few successors of a state. Uniforms are pre-drawn in blocks from a numpy Generator.
+    """
+    def __init__(self, P, rng = None, block_size = 4096):
+        self.P = P
+        self.rng = np.random.default_rng() if rng is None else rng
+        self.block_size = block_size
+
+        # For CSR matrices the data array is shared, so rows modified in place can be refreshed with update_rows
+        P = csr_matrix(P)
+        self.indptr = P.indptr
+        self.indices = P.indices
+        self.data = P.data
+        self.cdf = np.empty(len(P.data))
+        self.update_rows(np.arange(P.shape[0]))
+
+        self._uniforms = self.rng.random(block_size)
+        self._position = 0
+
+    def update_rows(self, rows):
+        """Recompute the cumulative distributions of the given rows."""
+
+        positions, lengths, offsets = row_positions(self.indptr, np.asarray(rows))
+        if len(positions) == 0:
+            return
+
+        weights = self.data[positions]
+        cumulative = np.cumsum(weights)
+        cumulative -= np.repeat(cumulative[offsets] - weights[offsets], lengths)
+        self.cdf[positions] = cumulative / np.repeat(cumulative[offsets + lengths - 1], lengths)
+
+    def uniform(self):
+        """Return the next pre-drawn uniform sample in [0, 1)."""
+
+        if self._position == self.block_size:
+            self.rng.random(out=self._uniforms)
+            self._position = 0
+        u = self._uniforms[self._position]
+        self._position += 1
+        return u
+
+    def sample(self, row):
+        """Sample a column (next state) from the distribution of a row."""
+
+        start, end = self.indptr[row], self.indptr[row + 1]
+        if end - start == 1:
+            return self.indices[start]
+        return self.indices[start + self.cdf[start:end - 1].searchsorted(self.uniform(), side='right')]
+
+    def sample_batch(self, rows):
+        """Sample one column (next state) for each of the given rows in a single vectorized draw."""
+
+        starts = self.indptr[rows]
+        lengths = self.indptr[rows + 1] - starts
+        u = self.rng.random(len(rows))
+
+        # Count the entries of every row's distribution below its uniform, padding shorter rows with infinity
+        offsets = np.arange(lengths.max() - 1)
+        cdf = self.cdf[np.minimum(starts[:, np.newaxis] + offsets, len(self.cdf) - 1)]
+        cdf[offsets >= lengths[:, np.newaxis] - 1] = np.inf
+        return self.indices[starts + (cdf <= u[:, np.newaxis]).sum(axis=1)]
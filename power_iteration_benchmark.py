@@ -0,0 +1,60 @@
+from environments.minigrids import Minigrid_LMDP, Minigrid_LMDP_transition
+from scipy.sparse import diags
+import numpy as np
+import time
+
+
+def reference_power_iteration(lmdp, lmbda = 1, epsilon = 1e-10):
+    """Power iteration as originally implemented, kept as the baseline of the benchmark.
+    G is built with a sparse diagonal instead of a dense one so that large grids fit in memory, which does not change the per-iteration cost."""
+
+    P0 = lmdp.P0
+    Z = np.ones(lmdp.n_states)
+    V_diff = np.arange(lmdp.n_states)
+    n_steps = 0
+
+    G = diags(np.exp(lmdp.R[:lmdp.n_nonterminal_states] / lmbda), format='csr')
+    ZT = np.exp(lmdp.R[lmdp.n_nonterminal_states:] / lmbda)
+
+    while max(V_diff) - min(V_diff) > epsilon:
+        TZ = G @ P0 @ Z
+        TZ = np.concatenate((TZ, ZT))
+        V_diff = lmdp.Z_to_V(TZ, lmbda) - lmdp.Z_to_V(Z, lmbda)
+        Z = TZ
+        n_steps += 1
+
+    return Z, n_steps
+
+
+if __name__ == "__main__":
+
+    lmbda = 1
+    epsilon = 1e-10
+
+    for grid_size in [50, 100]:
+
+        start_time = time.time()
+        minigrid_lmdp = Minigrid_LMDP(grid_size=grid_size, lmbda=lmbda)
+        print(f"Grid size: {grid_size}x{grid_size}, States: {minigrid_lmdp.n_states}, Construction time: {time.time() - start_time:.2f}s")
+
+        start_time = time.time()
+        Z_ref, n_steps_ref = reference_power_iteration(minigrid_lmdp, lmbda, epsilon)
+        reference_time = (time.time() - start_time) / n_steps_ref
+        print(f"  Reference power iteration: {n_steps_ref} iterations, {reference_time*1e3:.3f}ms per iteration")
+
+        start_time = time.time()
+        Z, n_steps = minigrid_lmdp.power_iteration(lmbda, epsilon)
+        kernel_time = (time.time() - start_time) / n_steps
+        print(f"  In-place power iteration: {n_steps} iterations, {kernel_time*1e3:.3f}ms per iteration")
+
+        print(f"  Speedup: {reference_time / kernel_time:.1f}x, Max |V difference|: {np.max(np.abs(minigrid_lmdp.Z_to_V(Z) - minigrid_lmdp.Z_to_V(Z_ref))):.2e}")
+
+        start_time = time.time()
+        log_Z, n_steps = minigrid_lmdp.power_iteration_log(lmbda, epsilon)
+        log_time = (time.time() - start_time) / n_steps
+        print(f"  Log-domain power iteration: {n_steps} iterations, {log_time*1e3:.3f}ms per iteration, {log_time / kernel_time:.1f}x the in-place cost, Max |V difference|: {np.max(np.abs(lmbda * log_Z - minigrid_lmdp.Z_to_V(Z))):.2e}")
+
+        minigrid_lmdp_transition = Minigrid_LMDP_transition(grid_size=grid_size, lmbda=lmbda)
+        start_time = time.time()
+        _, n_steps = minigrid_lmdp_transition.power_iteration(lmbda, epsilon)
+        print(f"  In-place power iteration (transition LMDP): {n_steps} iterations, {(time.time() - start_time) / n_steps * 1e3:.3f}ms per iteration")
@@ -6,6 +6,7 @@ from algs.zlearning import ZLearning, Zlearning_training
 from algs.qlearning import QLearning, Qlearning_training
 from utils.lmdp_plot import Minigrid_LMDP_Plotter
 import time
+from utils.cache import ModelCache
 
 simple6_map = [
     "########",
@@ -121,15 +122,18 @@ if __name__ == "__main__":
     n_iters = int(1e5)
     lmbda = 1
 
+    # Compiled models and solutions are reused across runs
+    cache = ModelCache()
+
     # MDP
-    minigrid_mdp = Minigrid_MDP(grid_size=grid_size, objects = objects, map=grid_map, gamma=gamma)
+    minigrid_mdp = cache.minigrid(Minigrid_MDP, grid_size=grid_size, objects = objects, map=grid_map, gamma=gamma)
     minigrid_mdp_plotter = Minigrid_MDP_Plotter(minigrid_mdp)
-    minigrid_lmdp = Minigrid_LMDP(grid_size=grid_size, objects=objects, map=grid_map, lmbda=lmbda)
+    minigrid_lmdp = cache.minigrid(Minigrid_LMDP, grid_size=grid_size, objects=objects, map=grid_map, lmbda=lmbda)
     minigrid_lmdp_plotter = Minigrid_LMDP_Plotter(minigrid_lmdp)
 
     minigrid_mdp.render()
 
-    Q, policy, n_steps = minigrid_mdp.value_iteration(epsilon=epsilon)
+    Q, policy, n_steps = cache.value_iteration(minigrid_mdp, epsilon=epsilon)
     V = Q.max(axis=1)
 
 
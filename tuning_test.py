@@ -7,6 +7,7 @@ from algs.zlearning import ZLearning, Zlearning_training
 from algs.qlearning import QLearning, Qlearning_training
 from utils.lmdp_plot import Minigrid_LMDP_Plotter
 from scipy.sparse import csr_matrix
+from utils.cache import ModelCache
 
 simple6_map = [
     "########",
@@ -118,10 +119,13 @@ if __name__ == "__main__":
     grid_size = len(grid_map)-2 if grid_map is not None else grid_size
 
 
+    # Compiled models and solutions are reused across runs
+    cache = ModelCache()
+
     # MDP
-    minigrid_mdp = Minigrid_MDP(grid_size, objects=objects, map = grid_map)
+    minigrid_mdp = cache.minigrid(Minigrid_MDP, grid_size, objects=objects, map = grid_map)
 
-    minigrid_lmdp = Minigrid_LMDP(grid_size, objects=objects, map = grid_map)
+    minigrid_lmdp = cache.minigrid(Minigrid_LMDP, grid_size, objects=objects, map = grid_map)
 
     minigrid_mdp_plots = Minigrid_MDP_Plotter(minigrid_mdp)
     
@@ -131,7 +135,7 @@ if __name__ == "__main__":
     n_iters = int(7e4)
     lmbda = 1
 
-    Z, _ = minigrid_lmdp.power_iteration(lmbda = lmbda, epsilon=epsilon)
+    Z, _ = cache.power_iteration(minigrid_lmdp, lmbda = lmbda, epsilon=epsilon)
     V = minigrid_lmdp.Z_to_V(Z)
     minigrid_mdp_plots.plot_minigrid(minigrid_mdp, grid_size, V)
 
@@ -0,0 +1,160 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+from scipy.sparse import csr_matrix, issparse
+from frameworks.mdp import MDP
+from frameworks.lmdp_transition import LMDP_transition
+from environments.minigrids import terminal_rewards
+from environments.minigrid_compiler import CompiledMinigrid
+
+
+DEFAULT_CACHE_DIR = os.environ.get("MINIGRID_CACHE_DIR", "cache")
+# Part of every key, to be increased whenever the way models or solutions are built changes so stale entries are not served
+CACHE_VERSION = 1
+
+
+def fingerprint(*parts):
+    """Return a content hash of the given parts. Arrays and sparse matrices are hashed by their bytes, other values
+    by their JSON representation."""
+
+    h = hashlib.sha1()
+    for part in parts:
+        if issparse(part):
+            part = csr_matrix(part)
+            for array in (part.data, part.indices, part.indptr, np.array(part.shape)):
+                h.update(np.ascontiguousarray(array).tobytes())
+        elif isinstance(part, np.ndarray):
+            h.update(str((part.dtype, part.shape)).encode())
+            h.update(np.ascontiguousarray(part).tobytes())
+        else:
+            h.update(json.dumps(part, sort_keys=True, default=str).encode())
+        h.update(b"|")
+    return h.hexdigest()
+
+
+class ModelCache:
+    """
+    Content addressed on-disk cache of compiled models and their solutions.
+
+    Every entry is a directory of raw .npy files, one per array (CSR matrices are split into their data, indices and
+    indptr arrays), so loads are memory-mapped and processes reading the same entry share the pages.
+    With the default copy-on-write mode the loaded arrays can be modified without touching the files.
+    """
+    def __init__(self, directory = DEFAULT_CACHE_DIR, mmap_mode = 'c'):
+        self.directory = directory
+        self.mmap_mode = mmap_mode
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def has(self, key):
+        return os.path.isdir(self.path(key))
+
+    def save(self, key, arrays):
+        """Store a dictionary of dense arrays, sparse matrices and scalars under a key."""
+
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=self.directory)
+        sparse = []
+        for name, value in arrays.items():
+            if issparse(value):
+                value = csr_matrix(value)
+                for field in ("data", "indices", "indptr"):
+                    np.save(os.path.join(tmp, f"{name}.{field}.npy"), getattr(value, field))
+                np.save(os.path.join(tmp, f"{name}.shape.npy"), np.array(value.shape))
+                sparse.append(name)
+            else:
+                np.save(os.path.join(tmp, f"{name}.npy"), np.asarray(value))
+        with open(os.path.join(tmp, "sparse.json"), "w") as f:
+            json.dump(sparse, f)
+
+        # Entries are published atomically, if another process won the race its entry is kept
+        try:
+            os.rename(tmp, self.path(key))
+        except OSError:
+            shutil.rmtree(tmp)
+
+    def load(self, key):
+        """Return the dictionary stored under a key, memory-mapped, or None if it is not cached."""
+
+        if not self.has(key):
+            return None
+
+        path = self.path(key)
+        with open(os.path.join(path, "sparse.json")) as f:
+            sparse = json.load(f)
+
+        arrays = {}
+        for file in os.listdir(path):
+            name = file[:-len(".npy")]
+            if file.endswith(".npy") and name.split(".")[0] not in sparse:
+                array = np.load(os.path.join(path, file), mmap_mode=self.mmap_mode)
+                arrays[name] = array if array.ndim else array.item()
+        for name in sparse:
+            data, indices, indptr = (np.load(os.path.join(path, f"{name}.{field}.npy"), mmap_mode=self.mmap_mode) for field in ("data", "indices", "indptr"))
+            shape = tuple(np.load(os.path.join(path, f"{name}.shape.npy")))
+            arrays[name] = csr_matrix((data, indices, indptr), shape=shape, copy=False)
+        return arrays
+
+    def get_or_compute(self, key, compute):
+        """Return the arrays cached under a key, calling compute() to produce and store them on a miss."""
+
+        arrays = self.load(key)
+        if arrays is None:
+            self.save(key, compute())
+            arrays = self.load(key)
+        return arrays
+
+    # Models
+
+    def minigrid(self, cls, grid_size = 14, objects = {}, map = None, **kwargs):
+        """Build a Minigrid_MDP, Minigrid_LMDP or Minigrid_LMDP_transition with its compiled layout and dynamics
+        taken from the cache, so a hit compiles nothing.
+
+        The key is derived from the class, the map (or the objects), the terminal rewards and the remaining
+        constructor arguments (gamma or lmbda)."""
+
+        layout = map if map is not None else {name: sorted(tuple(position) for position in positions) for name, positions in objects.items()}
+        key = fingerprint(CACHE_VERSION, cls.__name__, grid_size, layout, terminal_rewards(grid_size), sorted(kwargs.items()))
+
+        arrays = self.load(key)
+        if arrays is not None:
+            model = CompiledMinigrid.from_arrays(grid_size, {name[len("model."):]: value for name, value in arrays.items() if name.startswith("model.")})
+            dynamics = {name: value for name, value in arrays.items() if not name.startswith("model.")}
+            return cls(grid_size, objects=objects, map=map, dynamics=dynamics, model=model, **kwargs)
+
+        env = cls(grid_size, objects=objects, map=map, **kwargs)
+        fields = ("P", "R") if isinstance(env, MDP) else ("P0", "R", "J") if isinstance(env, LMDP_transition) else ("P0", "R")
+        model = {f"model.{name}": value for name, value in env.model.to_arrays().items()}
+        self.save(key, {name: getattr(env, name) for name in fields} | model)
+        return env
+
+    # Solutions
+
+    def value_iteration(self, mdp, epsilon = 1e-10):
+        """Value iteration of an MDP, cached by the content of its dynamics, gamma and epsilon."""
+
+        key = fingerprint(CACHE_VERSION, "value_iteration", mdp.P, mdp.R, mdp.gamma, epsilon)
+
+        def compute():
+            Q, policy, n_steps = mdp.value_iteration(epsilon)
+            return {"Q": Q, "V": Q.max(axis=1), "policy": policy, "n_steps": n_steps}
+
+        solution = self.get_or_compute(key, compute)
+        return solution["Q"], solution["policy"], solution["n_steps"]
+
+    def power_iteration(self, lmdp, lmbda = None, epsilon = 1e-10):
+        """Power iteration of an LMDP, cached by the content of its dynamics, lambda and epsilon."""
+
+        lmbda = lmdp.lmbda if lmbda is None else lmbda
+        key = fingerprint(CACHE_VERSION, "power_iteration", lmdp.P0, lmdp.R, getattr(lmdp, "J", None), lmbda, epsilon)
+
+        def compute():
+            Z, n_steps = lmdp.power_iteration(lmbda, epsilon)
+            return {"Z": Z, "V": lmdp.Z_to_V(Z, lmbda), "n_steps": n_steps}
+
+        solution = self.get_or_compute(key, compute)
+        return solution["Z"], solution["n_steps"]